@@ -1,10 +1,8 @@
 import random
 
 def sample_humanoid(name_list, num_samples):
-    samples = []
-    for i in range(num_samples):
-        samples.append(random.sample(name_list, 1)[0])
-    return samples
+    # 復元抽出で num_samples 個をまとめてサンプリング
+    return random.choices(name_list, k=num_samples)
 
 names_list = ["female_0", "female_1", "female_2", "female_3", "male_0", "male_1", "male_2", "male_3"]
 
@@ -24,6 +24,15 @@ from habitat.tasks.nav.multi_nav_task import (
 
 CONTENT_SCENES_PATH_FIELD = "content_scenes_path"
 DEFAULT_SCENE_PATH_PREFIX = "data/scene_datasets/"
+# The default 8 KiB file buffer turns a dataset read into many small
+# read() calls, so the gzip files are read through a 1 MiB buffer.
+READ_BUFFER_SIZE = 1 << 20
+
+
+def _read_gzip_text(path: str) -> str:
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as raw:
+        with gzip.GzipFile(fileobj=raw) as f:
+            return f.read().decode("utf-8")
 
 
 @registry.register_dataset(name="MaximumInfo-v1")
@@ -93,8 +102,9 @@ class MaximumInfoDatasetV1(Dataset):
             return
 
         datasetfile_path = config.DATA_PATH.format(split=config.SPLIT)
-        with gzip.open(datasetfile_path, "rt") as f:
-            self.from_json(f.read(), scenes_dir=config.SCENES_DIR)
+        self.from_json(
+            _read_gzip_text(datasetfile_path), scenes_dir=config.SCENES_DIR
+        )
 
         # Read separate file for each scene
         dataset_dir = os.path.dirname(datasetfile_path)
@@ -115,8 +125,10 @@ class MaximumInfoDatasetV1(Dataset):
                 scene_filename = self.content_scenes_path.format(
                     data_path=dataset_dir, scene=scene
                 )
-                with gzip.open(scene_filename, "rt") as f:
-                    self.from_json(f.read(), scenes_dir=config.SCENES_DIR)
+                self.from_json(
+                    _read_gzip_text(scene_filename),
+                    scenes_dir=config.SCENES_DIR,
+                )
 
         else:
             self.episodes = list(
@@ -63,3 +63,16 @@ def generate_maximuminfo_episode2(sim: Simulator, num_episodes: int = -1, z_list
 
         episode_count += 1
         yield episode
+
+
+def generate_maximuminfo_start_z(sim: Simulator, num_episodes: int) -> np.ndarray:
+    r"""Samples the same start positions as generate_maximuminfo_episode
+    would, but returns only their heights (``start_position[1]``) as a
+    float64 array instead of building episode objects.
+    """
+    start_z = np.empty(num_episodes, dtype=np.float64)
+    for episode_count in range(num_episodes):
+        if episode_count % 100000 == 0:
+            logger.info(episode_count)
+        start_z[episode_count] = sim.sample_navigable_point()[1]
+    return start_z
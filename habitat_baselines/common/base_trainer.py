@@ -97,21 +97,25 @@ class BaseRLTrainerOracle(BaseTrainer):
             else:
                 # evaluate multiple checkpoints in order
                 prev_ckpt_ind = 1075
-                while True:
-                    current_ckpt = None
-                    while current_ckpt is None:
-                        current_ckpt = poll_checkpoint_folder(
-                            self.config.EVAL_CKPT_PATH_DIR, prev_ckpt_ind
+                try:
+                    while True:
+                        current_ckpt = None
+                        while current_ckpt is None:
+                            current_ckpt = poll_checkpoint_folder(
+                                self.config.EVAL_CKPT_PATH_DIR, prev_ckpt_ind
+                            )
+                            # time.sleep(2)   # sleep for 2 secs before polling again
+                        logger.info(f"=======current_ckpt: {current_ckpt}=======")
+                        prev_ckpt_ind += 1
+                        self._eval_checkpoint(
+                            checkpoint_path=current_ckpt,
+                            log_manager=log_manager,
+                            date=date,
+                            checkpoint_index=prev_ckpt_ind,
                         )
-                        # time.sleep(2)   # sleep for 2 secs before polling again
-                    logger.info(f"=======current_ckpt: {current_ckpt}=======")
-                    prev_ckpt_ind += 1
-                    self._eval_checkpoint(
-                        checkpoint_path=current_ckpt,
-                        log_manager=log_manager,
-                        date=date,
-                        checkpoint_index=prev_ckpt_ind,
-                    )
+                finally:
+                    # 止められた時もLogWriterのファイルを閉じておく
+                    log_manager.closeAll()
                     
     def grad_cam(self, log_manager, date) -> None:
         logger.info("GRAD_CAM")
@@ -128,21 +132,25 @@ class BaseRLTrainerOracle(BaseTrainer):
 
         # evaluate multiple checkpoints in order
         prev_ckpt_ind = 1075
-        while True:
-            current_ckpt = None
-            while current_ckpt is None:
-                current_ckpt = poll_checkpoint_folder(
-                    self.config.EVAL_CKPT_PATH_DIR, prev_ckpt_ind
+        try:
+            while True:
+                current_ckpt = None
+                while current_ckpt is None:
+                    current_ckpt = poll_checkpoint_folder(
+                        self.config.EVAL_CKPT_PATH_DIR, prev_ckpt_ind
+                    )
+                    # time.sleep(2)   # sleep for 2 secs before polling again
+                logger.info(f"=======current_ckpt: {current_ckpt}=======")
+                prev_ckpt_ind += 1
+                self._grad_cam_checkpoint(
+                    checkpoint_path=current_ckpt,
+                    log_manager=log_manager,
+                    date=date,
+                    checkpoint_index=prev_ckpt_ind,
                 )
-                # time.sleep(2)   # sleep for 2 secs before polling again
-            logger.info(f"=======current_ckpt: {current_ckpt}=======")
-            prev_ckpt_ind += 1
-            self._grad_cam_checkpoint(
-                checkpoint_path=current_ckpt,
-                log_manager=log_manager,
-                date=date,
-                checkpoint_index=prev_ckpt_ind,
-            )
+        finally:
+            # 止められた時もLogWriterのファイルを閉じておく
+            log_manager.closeAll()
 
     def _setup_eval_config(self, checkpoint_config: Config) -> Config:
         r"""Sets up and returns a merged config for evaluation. Config
@@ -226,11 +234,7 @@ class BaseRLTrainerOracle(BaseTrainer):
         envs,
         test_recurrent_hidden_states,
         not_done_masks,
-        current_episode_reward,
-        current_episode_exp_area,
-        current_episode_distance,
-        current_episode_ci,
-        current_episode_object_num,
+        current_episode_stats,
         #current_episode_num_exp,
         prev_actions,
         batch,
@@ -248,11 +252,7 @@ class BaseRLTrainerOracle(BaseTrainer):
                 :, state_index
             ]
             not_done_masks = not_done_masks[state_index]
-            current_episode_reward = current_episode_reward[state_index]
-            current_episode_exp_area = current_episode_exp_area[state_index]
-            current_episode_distance = current_episode_distance[state_index]
-            current_episode_ci = current_episode_ci[state_index]
-            current_episode_object_num = current_episode_object_num[state_index]
+            current_episode_stats = current_episode_stats[state_index]
             #current_episode_num_exp = current_episode_num_exp[state_index]
             prev_actions = prev_actions[state_index]
 
@@ -265,11 +265,7 @@ class BaseRLTrainerOracle(BaseTrainer):
             envs,
             test_recurrent_hidden_states,
             not_done_masks,
-            current_episode_reward,
-            current_episode_exp_area,
-            current_episode_distance,
-            current_episode_ci,
-            current_episode_object_num,
+            current_episode_stats,
             #current_episode_num_exp,
             prev_actions,
             batch,
@@ -22,6 +22,7 @@ class RolloutStorageOracle:
         action_space,
         recurrent_hidden_state_size,
         num_recurrent_layers=1,
+        goal_sensor_uuid=None,
     ):
         self.observations = {}
 
@@ -32,6 +33,12 @@ class RolloutStorageOracle:
                 *observation_space.spaces[sensor].shape
             )
 
+        # goalはEmbeddingの添字として使うので、insert時にlongへ変換して保持する
+        if goal_sensor_uuid is not None:
+            self.observations[goal_sensor_uuid] = self.observations[
+                goal_sensor_uuid
+            ].long()
+
         
         self.observations["semMap"] = torch.zeros(
                 num_steps+1, 
@@ -96,6 +103,15 @@ class RolloutStorageOracle:
         self.prev_actions = self.prev_actions.to(device)
         self.masks = self.masks.to(device)
 
+    def observations_at(self, step):
+        r"""Returns views of the observation slot at ``step``, so callers
+        can write a new batch into the storage without an extra copy.
+        """
+        return {
+            sensor: self.observations[sensor][step]
+            for sensor in self.observations
+        }
+
     def insert(
         self,
         observations,
@@ -106,10 +122,13 @@ class RolloutStorageOracle:
         rewards,
         masks,
     ):
-        for sensor in observations:
-            self.observations[sensor][self.step + 1].copy_(
-                observations[sensor]
-            )
+        # observations is None when they were already written in place
+        # through observations_at(step + 1)
+        if observations is not None:
+            for sensor in observations:
+                self.observations[sensor][self.step + 1].copy_(
+                    observations[sensor]
+                )
         self.recurrent_hidden_states[self.step + 1].copy_(
             recurrent_hidden_states
         )
@@ -117,7 +136,10 @@ class RolloutStorageOracle:
         self.prev_actions[self.step + 1].copy_(actions)
         self.action_log_probs[self.step].copy_(action_log_probs)
         self.value_preds[self.step].copy_(value_preds)
-        self.rewards[self.step].copy_(rewards)
+        # rewards is None when the trainer writes them into
+        # self.rewards[step] later
+        if rewards is not None:
+            self.rewards[self.step].copy_(rewards)
         self.masks[self.step + 1].copy_(masks)
 
         self.step = self.step + 1
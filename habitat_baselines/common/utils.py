@@ -39,6 +39,14 @@ class CustomFixedCategorical(torch.distributions.Categorical):
     def mode(self):
         return self.probs.argmax(dim=-1, keepdim=True)
 
+    def sample_with_log_probs(self):
+        r"""Samples actions and returns them together with their log
+        probabilities, gathered from the already normalized logits instead
+        of a second log_probs pass.
+        """
+        actions = torch.multinomial(self.probs, 1)
+        return actions, self.logits.gather(-1, actions)
+
 
 class CategoricalNet(nn.Module):
     def __init__(self, num_inputs, num_outputs):
@@ -76,8 +84,30 @@ def _to_tensor(v):
         return torch.tensor(v, dtype=torch.float)
 
 
+def _get_pinned_buffer(
+    cache: Dict[str, tuple], sensor: str, tensors: List[torch.Tensor]
+) -> torch.Tensor:
+    shape = (len(tensors), *tensors[0].shape)
+    buffer, copy_done = cache.get(sensor, (None, None))
+    if (
+        buffer is None
+        or buffer.shape != shape
+        or buffer.dtype != tensors[0].dtype
+    ):
+        buffer = torch.empty(shape, dtype=tensors[0].dtype).pin_memory()
+        copy_done = torch.cuda.Event()
+    else:
+        # the previous non-blocking upload may still be reading the buffer
+        copy_done.synchronize()
+    cache[sensor] = (buffer, copy_done)
+    return buffer
+
+
 def batch_obs(
-    observations: List[Dict], device: Optional[torch.device] = None
+    observations: List[Dict],
+    device: Optional[torch.device] = None,
+    cache: Optional[Dict[str, tuple]] = None,
+    out: Optional[Dict[str, torch.Tensor]] = None,
 ) -> Dict[str, torch.Tensor]:
     r"""Transpose a batch of observation dicts to a dict of batched
     observations.
@@ -86,6 +116,14 @@ def batch_obs(
         observations:  list of dicts of observations.
         device: The torch.device to put the resulting tensors on.
             Will not move the tensors if None
+        cache: dict kept by the caller between calls. When given and
+            device is a cuda device, observations are stacked into
+            persistent pinned host buffers and uploaded with non-blocking
+            copies.
+        out: optional dict of preallocated tensors, e.g. a rollout storage
+            slot. Sensors found in it are written there directly (cast to
+            the dtype of the destination) and the returned batch holds
+            those tensors.
 
     Returns:
         transposed dict of lists of observations.
@@ -99,7 +137,28 @@ def batch_obs(
             
             batch[sensor].append(_to_tensor(obs[sensor]))
 
+    use_pinned = (
+        cache is not None
+        and device is not None
+        and torch.device(device).type == "cuda"
+    )
     for sensor in batch:
+        if use_pinned and batch[sensor][0].device.type == "cpu":
+            buffer = _get_pinned_buffer(cache, sensor, batch[sensor])
+            torch.stack(batch[sensor], dim=0, out=buffer)
+            if out is not None and sensor in out:
+                batch[sensor] = out[sensor].copy_(buffer, non_blocking=True)
+                cache[sensor][1].record()
+            else:
+                batch[sensor] = buffer.to(device=device, non_blocking=True)
+                cache[sensor][1].record()
+                batch[sensor] = batch[sensor].to(dtype=torch.float)
+            continue
+
+        if out is not None and sensor in out:
+            batch[sensor] = out[sensor].copy_(torch.stack(batch[sensor], dim=0))
+            continue
+
         batch[sensor] = (
             torch.stack(batch[sensor], dim=0)
             .to(device=device)
@@ -43,6 +43,16 @@ _C.EVAL = CN()
 # The split to evaluate on
 _C.EVAL.SPLIT = "val"
 _C.EVAL.USE_CKPT_CONFIG = True
+# Cast the embeddings and output heads to bfloat16 and run act under autocast
+_C.EVAL.USE_BF16 = False
+# -----------------------------------------------------------------------------
+# GRAD-CAM CONFIG
+# -----------------------------------------------------------------------------
+_C.GRADCAM = CN()
+# Compute Grad-CAM heatmaps while running grad_cam
+_C.GRADCAM.ENABLED = True
+# Compute a heatmap only once every STRIDE steps
+_C.GRADCAM.STRIDE = 1
 # -----------------------------------------------------------------------------
 # REINFORCEMENT LEARNING (RL) ENVIRONMENT CONFIG
 # -----------------------------------------------------------------------------
@@ -79,6 +89,12 @@ _C.RL.PPO.tau = 0.95
 _C.RL.PPO.reward_window_size = 50
 _C.RL.PPO.use_normalized_advantage = True
 _C.RL.PPO.hidden_size = 512
+# Capture PolicyOracle.act as a CUDA graph during rollouts
+_C.RL.PPO.use_cuda_graph = False
+# Compile the visual, map and state encoders with torch.compile
+_C.RL.PPO.compile_model = False
+# Run the policy forward passes under bfloat16 autocast
+_C.RL.PPO.use_amp = False
 # -----------------------------------------------------------------------------
 # MAPS
 # -----------------------------------------------------------------------------
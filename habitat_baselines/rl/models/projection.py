@@ -1,10 +1,8 @@
-from einops import rearrange
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch_scatter
 
 
 def get_grid(pose, grid_size, device):
@@ -57,8 +55,8 @@ class ComputeSpatialLocs():
     def forward(self, depth):
         depth = depth.permute(0, 3, 1, 2)
         _, _, imh, imw = depth.shape   # batchsize, 1, imh, imw
-        x    = rearrange(torch.arange(0, imw), 'w -> () () () w').to(self.device)
-        y    = rearrange(torch.arange(imh, 0, step=-1), 'h -> () () h ()').to(self.device)
+        x    = torch.arange(0, imw).view(1, 1, 1, imw).to(self.device)
+        y    = torch.arange(imh, 0, step=-1).view(1, 1, imh, 1).to(self.device)
         xx   = (x - self.cx) / self.fx
         yy   = (y - self.cy) / self.fy
         
@@ -109,22 +107,20 @@ class ProjectToGroundPlane():
         spatial_locs_ss[:, 1][invalid_writes] = 0
 
         # Weird hack to account for max-pooling negative feature values
-        invalid_writes_f = rearrange(invalid_writes, 'b h w -> b () h w').float()
+        invalid_writes_f = invalid_writes.unsqueeze(1).float()
         conv_masked = conv * (1 - invalid_writes_f) + eps * invalid_writes_f
-        conv_masked = rearrange(conv_masked, 'b e h w -> b e (h w)')
+        conv_masked = conv_masked.reshape(bs, f, -1)
 
         # Linearize ground-plane indices (linear idx = y * W + x)
         linear_locs_ss = spatial_locs_ss[:, 1] * outw + spatial_locs_ss[:, 0] # (bs, H, W)
-        linear_locs_ss = rearrange(linear_locs_ss, 'b h w -> b () (h w)')
+        linear_locs_ss = linear_locs_ss.view(bs, 1, -1)
         linear_locs_ss = linear_locs_ss.expand(-1, f, -1) # .contiguous()
 
-        proj_feats, _ = torch_scatter.scatter_max(
-                            conv_masked,
-                            linear_locs_ss,
-                            dim=2,
-                            dim_size=outh*outw,
-                        )
-        proj_feats = rearrange(proj_feats, 'b e (h w) -> b e h w', h=outh)
+        proj_feats = conv_masked.new_full((bs, f, outh*outw), eps)
+        proj_feats.scatter_reduce_(
+            2, linear_locs_ss, conv_masked, reduce="amax", include_self=True
+        )
+        proj_feats = proj_feats.view(bs, f, outh, outw)
 
         # Replace invalid features with zeros
         eps_mask = (proj_feats == eps).float()
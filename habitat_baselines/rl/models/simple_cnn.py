@@ -233,6 +233,8 @@ class MapCNN(nn.Module):
             )
 
         self.layer_init()
+        # mapはNHWCで入力されるので、convもchannels_lastで実行する
+        self.to(memory_format=torch.channels_last)
 
     def _conv_output_dim(
         self, dimension, padding, dilation, kernel_size, stride
@@ -279,7 +281,10 @@ class MapCNN(nn.Module):
 
     def forward(self, observations):
         if self._n_input_map > 0:
-            map_observations = observations.permute(0, 3, 1, 2)
+            # NHWC -> NCHW is a view that is already laid out as channels_last
+            map_observations = observations.permute(0, 3, 1, 2).contiguous(
+                memory_format=torch.channels_last
+            )
         return self.cnn(map_observations)
     
 
@@ -361,6 +366,8 @@ class MapCNN_Pre(nn.Module):
             )
 
         self.layer_init()
+        # mapはNHWCで入力されるので、convもchannels_lastで実行する
+        self.to(memory_format=torch.channels_last)
 
     def _conv_output_dim(
         self, dimension, padding, dilation, kernel_size, stride
@@ -407,5 +414,8 @@ class MapCNN_Pre(nn.Module):
 
     def forward(self, observations):
         if self._n_input_map > 0:
-            map_observations = observations.permute(0, 3, 1, 2)
+            # NHWC -> NCHW is a view that is already laid out as channels_last
+            map_observations = observations.permute(0, 3, 1, 2).contiguous(
+                memory_format=torch.channels_last
+            )
         return self.cnn(map_observations)
\ No newline at end of file
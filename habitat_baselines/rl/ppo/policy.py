@@ -4,36 +4,82 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 import abc
-import math
-import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from habitat_baselines.common.utils import CategoricalNet, Flatten, to_grid
-from habitat_baselines.rl.models.projection import Projection, RotateTensor, get_grid
+from habitat_baselines.common.utils import CategoricalNet
 from habitat_baselines.rl.models.rnn_state_encoder import RNNStateEncoder
 from habitat_baselines.rl.models.simple_cnn import RGBCNNOracle, MapCNN, MapCNN_Pre
-from habitat_baselines.rl.models.projection import Projection
-from habitat.core.logging import logger
-from utils.log_manager import LogManager
-from utils.log_writer import LogWriter
 
 
 
 class PolicyOracle(nn.Module):
-    def __init__(self, net, dim_actions):
+    def __init__(
+        self,
+        net,
+        dim_actions,
+        use_cuda_graph=False,
+        compile_model=False,
+        use_amp=False,
+    ):
         super().__init__()
         self.net = net
         self.dim_actions = dim_actions
 
+        if compile_model:
+            self.net.compile_submodules(use_cuda_graph)
+
         self.action_distribution = CategoricalNet(
             self.net.output_size, self.dim_actions
         )
         self.critic = CriticHead(self.net.output_size)
 
+        # rollout中のactをCUDA Graphとしてキャプチャし、replayで実行する
+        self.use_cuda_graph = use_cuda_graph
+        self._act_graph = None
+        self._act_graph_training = None
+        self._static_inputs = None
+        self._static_outputs = None
+
+        # to_inference で設定される推論時のdtype
+        self._inference_dtype = None
+        # act/get_value/evaluate_actions を bfloat16 の autocast で実行する
+        self.use_amp = use_amp
+
     def forward(self, *x):
         raise NotImplementedError
 
+    def _autocast(self, device):
+        dtype = self._inference_dtype
+        if dtype is None and self.use_amp:
+            dtype = torch.bfloat16
+        return torch.autocast(
+            device_type=device.type, dtype=dtype, enabled=dtype is not None
+        )
+
+    def to_inference(self, dtype=torch.bfloat16):
+        r"""Switches the policy to eval mode and casts the small, memory-bound
+        layers (embedding tables, critic and action heads) for inference.
+
+        Args:
+            dtype: ``torch.bfloat16``/``torch.float16`` casts those layers and
+                runs act under autocast with that dtype. ``torch.qint8``
+                dynamically quantizes every ``nn.Linear`` instead (CPU only).
+        """
+        self.eval()
+        if dtype == torch.qint8:
+            torch.ao.quantization.quantize_dynamic(
+                self, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+            return self
+
+        self.critic.fc.to(dtype)
+        self.action_distribution.linear.to(dtype)
+        for module in self.net.modules():
+            if isinstance(module, nn.Embedding):
+                module.to(dtype)
+        self._inference_dtype = dtype
+        return self
+
     def act(
         self,
         observations,
@@ -42,41 +88,147 @@ class PolicyOracle(nn.Module):
         masks,
         deterministic=False,
     ):
-        features, rnn_hidden_states = self.net(
-            observations, rnn_hidden_states, prev_actions, masks
-        )
+        if (
+            self.use_cuda_graph
+            and not deterministic
+            and masks.is_cuda
+            and not torch.is_grad_enabled()
+        ):
+            return self._act_graphed(
+                observations, rnn_hidden_states, prev_actions, masks
+            )
 
-        distribution = self.action_distribution(features)
-        value = self.critic(features)
+        return self._act_impl(
+            observations, rnn_hidden_states, prev_actions, masks, deterministic
+        )
 
-        if deterministic:
-            action = distribution.mode()
+    def act_train(self, *args, **kwargs):
+        r"""act for rollout collection. Makes sure the policy is in train
+        mode before acting.
+        """
+        if not self.training:
+            self.train()
+        return self.act(*args, **kwargs)
+
+    def act_inference(self, *args, **kwargs):
+        r"""act for evaluation. Switches the policy to eval mode once, so a
+        captured CUDA graph or compiled module never records train-mode
+        kernels.
+        """
+        if self.training:
+            self.eval()
+        return self.act(*args, **kwargs)
+
+    def _act_graphed(self, observations, rnn_hidden_states, prev_actions, masks):
+        r"""Runs act by replaying a captured CUDA graph. The graph is
+        (re-)captured whenever the batch size, the observation keys or the
+        train/eval mode change.
+        """
+        if (
+            self._act_graph is None
+            or self._act_graph_training != self.training
+            or self._static_inputs["masks"].shape != masks.shape
+            or self._static_inputs["observations"].keys() != observations.keys()
+        ):
+            self._capture_act_graph(
+                observations, rnn_hidden_states, prev_actions, masks
+            )
         else:
-            action = distribution.sample()
+            for k, v in observations.items():
+                self._static_inputs["observations"][k].copy_(v)
+            self._static_inputs["rnn_hidden_states"].copy_(rnn_hidden_states)
+            self._static_inputs["prev_actions"].copy_(prev_actions)
+            self._static_inputs["masks"].copy_(masks)
 
-        action_log_probs = distribution.log_probs(action)
+        self._act_graph.replay()
 
-        return value, action, action_log_probs, rnn_hidden_states
+        # static outputs are overwritten by the next replay
+        return tuple(t.clone() for t in self._static_outputs)
 
-    def get_value(self, observations, rnn_hidden_states, prev_actions, masks):
-        features, _ = self.net(
-            observations, rnn_hidden_states, prev_actions, masks
+    def _capture_act_graph(
+        self, observations, rnn_hidden_states, prev_actions, masks
+    ):
+        self._static_inputs = dict(
+            observations={k: v.clone() for k, v in observations.items()},
+            rnn_hidden_states=rnn_hidden_states.clone(),
+            prev_actions=prev_actions.clone(),
+            masks=masks.clone(),
         )
-        return self.critic(features)
+
+        # warmup on a side stream before capture
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                self._act_impl(**self._static_inputs)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        self._act_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._act_graph):
+            self._static_outputs = self._act_impl(**self._static_inputs)
+        self._act_graph_training = self.training
+
+    def _act_impl(
+        self,
+        observations,
+        rnn_hidden_states,
+        prev_actions,
+        masks,
+        deterministic=False,
+    ):
+        hidden_dtype = rnn_hidden_states.dtype
+        with self._autocast(masks.device):
+            features, rnn_hidden_states = self.net(
+                observations, rnn_hidden_states, prev_actions, masks
+            )
+
+            distribution = self.action_distribution(features)
+
+            # action stays on the device; the caller moves it to the host
+            # once per step
+            if deterministic:
+                action = distribution.mode()
+                action_log_probs = distribution.log_probs(action)
+            else:
+                action, action_log_probs = distribution.sample_with_log_probs()
+
+            value = self.critic(features)
+
+        return (
+            value.float(),
+            action,
+            action_log_probs.float(),
+            rnn_hidden_states.to(hidden_dtype),
+        )
+
+    def get_value(self, observations, rnn_hidden_states, prev_actions, masks):
+        with self._autocast(masks.device):
+            features, _ = self.net(
+                observations, rnn_hidden_states, prev_actions, masks
+            )
+            value = self.critic(features)
+        return value.float()
 
     def evaluate_actions(
         self, observations, rnn_hidden_states, prev_actions, masks, action
     ):
-        features, rnn_hidden_states = self.net(
-            observations, rnn_hidden_states, prev_actions, masks
-        )
-        distribution = self.action_distribution(features)
-        value = self.critic(features)
+        hidden_dtype = rnn_hidden_states.dtype
+        with self._autocast(masks.device):
+            features, rnn_hidden_states = self.net(
+                observations, rnn_hidden_states, prev_actions, masks
+            )
+            distribution = self.action_distribution(features)
+            value = self.critic(features)
 
-        action_log_probs = distribution.log_probs(action)
-        distribution_entropy = distribution.entropy().mean()
+            action_log_probs = distribution.log_probs(action)
+            distribution_entropy = distribution.entropy().mean()
 
-        return value, action_log_probs, distribution_entropy, rnn_hidden_states
+        return (
+            value.float(),
+            action_log_probs.float(),
+            distribution_entropy.float(),
+            rnn_hidden_states.to(hidden_dtype),
+        )
 
 
 
@@ -103,6 +255,9 @@ class BaselinePolicyOracle(PolicyOracle):
         previous_action_embedding_size,
         use_previous_action,
         hidden_size=512,
+        use_cuda_graph=False,
+        compile_model=False,
+        use_amp=False,
     ):
         super().__init__(
             BaselineNetOracle(
@@ -116,6 +271,9 @@ class BaselinePolicyOracle(PolicyOracle):
                 use_previous_action=use_previous_action,
             ),
             action_space.n,
+            use_cuda_graph=use_cuda_graph,
+            compile_model=compile_model,
+            use_amp=use_amp,
         )
         
 
@@ -131,6 +289,9 @@ class ProposedPolicyOracle(PolicyOracle):
         previous_action_embedding_size,
         use_previous_action,
         hidden_size=512,
+        use_cuda_graph=False,
+        compile_model=False,
+        use_amp=False,
     ):
         super().__init__(
             ProposedNetOracle(
@@ -145,6 +306,9 @@ class ProposedPolicyOracle(PolicyOracle):
                 use_previous_action=use_previous_action,
             ),
             action_space.n,
+            use_cuda_graph=use_cuda_graph,
+            compile_model=compile_model,
+            use_amp=use_amp,
         )
 
 
@@ -167,6 +331,47 @@ class Net(nn.Module, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def is_blind(self):
         pass
+
+    def compile_submodules(self, use_cuda_graph=False):
+        r"""Compiles the visual, map and state encoders in place with
+        torch.compile so that parameter names in the state_dict are kept.
+        The embedding tables are left uncompiled.
+
+        Args:
+            use_cuda_graph: whether act is already captured as a CUDA graph,
+                in which case inductor's own cudagraphs are disabled
+        """
+        if use_cuda_graph:
+            compile_kwargs = dict(options={"triton.cudagraphs": False})
+        else:
+            compile_kwargs = dict(mode="reduce-overhead")
+
+        for name in ["visual_encoder", "map_encoder", "state_encoder"]:
+            module = getattr(self, name, None)
+            if module is not None:
+                module.compile(fullgraph=False, **compile_kwargs)
+
+    def _embed_map(self, global_map):
+        r"""Embeds the occupancy and object channels of semMap with a single
+        lookup into the fused ``map_embedding`` table.
+        """
+        idx = global_map[..., :2].to(self.device, dtype=torch.long, non_blocking=True)
+        idx = idx + self._map_channel_offset
+        return self.map_embedding(idx).flatten(3)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 分かれていた occupancy/object の埋め込みで学習したcheckpointを読み込めるようにする
+        occupancy_key = prefix + "occupancy_embedding.weight"
+        object_key = prefix + "object_embedding.weight"
+        if (
+            hasattr(self, "map_embedding")
+            and occupancy_key in state_dict
+            and object_key in state_dict
+        ):
+            state_dict[prefix + "map_embedding.weight"] = torch.cat(
+                [state_dict.pop(occupancy_key), state_dict.pop(object_key)]
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
             
 
 class BaselineNetOracle(Net):
@@ -190,8 +395,15 @@ class BaselineNetOracle(Net):
         self.visual_encoder = RGBCNNOracle(observation_space, 512)
         if agent_type == "oracle":
             self.map_encoder = MapCNN(50, 256, agent_type)
-            self.occupancy_embedding = nn.Embedding(3, 16)
-            self.object_embedding = nn.Embedding(10, 16)
+            # occupancy(3) と object(10) の埋め込みを1つのテーブルにまとめる
+            # weight[:3] が occupancy, weight[3:] が object に対応
+            self._occupancy_vocab = 3
+            self.map_embedding = nn.Embedding(self._occupancy_vocab + 10, 16)
+            self.register_buffer(
+                "_map_channel_offset",
+                torch.tensor([0, self._occupancy_vocab], dtype=torch.long).view(1, 1, 1, 2),
+                persistent=False,
+            )
             self.goal_embedding = nn.Embedding(9, object_category_embedding_size)
         elif agent_type == "no-map":
             self.goal_embedding = nn.Embedding(8, object_category_embedding_size)
@@ -213,7 +425,10 @@ class BaselineNetOracle(Net):
                 (self._hidden_size) + object_category_embedding_size,
                 self._hidden_size,   #Replace 2 by number of target categories later
             )
-        self.train()
+
+        # 構築後に変わらない値なので、forward毎に辿らないようにキャッシュする
+        self._is_blind = self.visual_encoder.is_blind
+        self._num_recurrent_layers = self.state_encoder.num_recurrent_layers
 
     @property
     def output_size(self):
@@ -221,38 +436,43 @@ class BaselineNetOracle(Net):
 
     @property
     def is_blind(self):
-        return self.visual_encoder.is_blind
+        return self._is_blind
 
     @property
     def num_recurrent_layers(self):
-        return self.state_encoder.num_recurrent_layers
+        return self._num_recurrent_layers
 
     def get_target_encoding(self, observations):
-        return observations[self.goal_sensor_uuid]
+        # rollout storage keeps the goal as a long tensor on the device, in
+        # which case this is a no-op
+        return observations[self.goal_sensor_uuid].to(
+            self.device, dtype=torch.long, non_blocking=True
+        )
 
     def forward(self, observations, rnn_hidden_states, prev_actions, masks):
         target_encoding = self.get_target_encoding(observations)
-        x = [self.goal_embedding((target_encoding).type(torch.LongTensor).to(self.device)).squeeze(1)]
-        bs = target_encoding.shape[0]
-        if not self.is_blind:
-            perception_embed = self.visual_encoder(observations)
-            x = [perception_embed] + x
+        goal_embed = self.goal_embedding(target_encoding).squeeze(1)
 
+        # state_encoder の入力は map, perception, goal, action の順に結合する
+        map_parts = ()
         if self.agent_type != "no-map":
-            global_map_embedding = []
             global_map = observations['semMap']
             #logger.info("global shape: " + str(global_map.shape))
             if self.agent_type == "oracle":
-                global_map_embedding.append(self.occupancy_embedding(global_map[:, :, :, 0].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 50, 50 , -1))
-            global_map_embedding.append(self.object_embedding(global_map[:, :, :, 1].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 50, 50, -1))
-            global_map_embedding = torch.cat(global_map_embedding, dim=3)
-            map_embed = self.map_encoder(global_map_embedding)
-            x = [map_embed] + x
+                global_map_embedding = self._embed_map(global_map)
+            else:
+                global_map_embedding = self.object_embedding(global_map[:, :, :, 1].to(self.device, dtype=torch.long, non_blocking=True))
+            map_parts = (self.map_encoder(global_map_embedding),)
+
+        perception_parts = ()
+        if not self.is_blind:
+            perception_parts = (self.visual_encoder(observations),)
 
+        action_parts = ()
         if self.use_previous_action:
-            x = torch.cat(x + [self.action_embedding(prev_actions).squeeze(1)], dim=1)
-        else:
-            x = torch.cat(x, dim=1)
+            action_parts = (self.action_embedding(prev_actions).squeeze(1),)
+
+        x = torch.cat(map_parts + perception_parts + (goal_embed,) + action_parts, dim=1)
         x, rnn_hidden_states = self.state_encoder(x, rnn_hidden_states, masks)
         return x, rnn_hidden_states  
     
@@ -280,8 +500,15 @@ class ProposedNetOracle(Net):
         if agent_type == "oracle-ego":
             self.map_encoder = MapCNN(50, 256, agent_type)
             #self.map_encoder = MapCNN(100, 256, agent_type)
-            self.occupancy_embedding = nn.Embedding(4, 16)
-            self.object_embedding = nn.Embedding(10, 16)
+            # occupancy(4) と object(10) の埋め込みを1つのテーブルにまとめる
+            # weight[:4] が occupancy, weight[4:] が object に対応
+            self._occupancy_vocab = 4
+            self.map_embedding = nn.Embedding(self._occupancy_vocab + 10, 16)
+            self.register_buffer(
+                "_map_channel_offset",
+                torch.tensor([0, self._occupancy_vocab], dtype=torch.long).view(1, 1, 1, 2),
+                persistent=False,
+            )
             self.goal_embedding = nn.Embedding(9, object_category_embedding_size)
         
         self.action_embedding = nn.Embedding(4, previous_action_embedding_size)
@@ -295,7 +522,10 @@ class ProposedNetOracle(Net):
             self.state_encoder = RNNStateEncoder(
                 (self._hidden_size), self._hidden_size,   #Replace 2 by number of target categories later
             )
-        self.train()
+
+        # 構築後に変わらない値なので、forward毎に辿らないようにキャッシュする
+        self._is_blind = self.visual_encoder.is_blind
+        self._num_recurrent_layers = self.state_encoder.num_recurrent_layers
 
     @property
     def output_size(self):
@@ -303,46 +533,35 @@ class ProposedNetOracle(Net):
 
     @property
     def is_blind(self):
-        return self.visual_encoder.is_blind
+        return self._is_blind
 
     @property
     def num_recurrent_layers(self):
-        return self.state_encoder.num_recurrent_layers
+        return self._num_recurrent_layers
     
     def get_target_encoding(self, observations):
-        return observations[self.goal_sensor_uuid]
+        # rollout storage keeps the goal as a long tensor on the device, in
+        # which case this is a no-op
+        return observations[self.goal_sensor_uuid].to(
+            self.device, dtype=torch.long, non_blocking=True
+        )
 
     def forward(self, observations, rnn_hidden_states, prev_actions, masks):
         target_encoding = self.get_target_encoding(observations)
-        x = [self.goal_embedding((target_encoding).type(torch.LongTensor).to(self.device)).squeeze(1)]
-        bs = observations['rgb'].shape[0]
-        if not self.is_blind:
-            perception_embed = self.visual_encoder(observations)
-            x = [perception_embed] + x
+        goal_embed = self.goal_embedding(target_encoding).squeeze(1)
 
-        global_map_embedding = []
-        
         global_map = observations['semMap']
-        global_map_embedding.append(self.occupancy_embedding(global_map[:, :, :, 0].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 50, 50 , -1))
-        global_map_embedding.append(self.object_embedding(global_map[:, :, :, 1].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 50, 50, -1))
-        """
-        global_map_mini = observations['semMap_mini']
-        global_map_big = observations['semMap_big']
-        global_map_embedding.append(self.occupancy_embedding(global_map_mini[:, :, :, 0].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 100, 100 , -1))
-        global_map_embedding.append(self.occupancy_embedding(global_map_big[:, :, :, 0].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 100, 100 , -1))
-        """
-        
-        global_map_embedding.append(self.object_embedding(global_map_mini[:, :, :, 1].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 100, 100, -1))
-        global_map_embedding.append(self.object_embedding(global_map_big[:, :, :, 1].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 100, 100, -1))
-        
-        global_map_embedding = torch.cat(global_map_embedding, dim=3)
-        map_embed = self.map_encoder(global_map_embedding)
-        x = [map_embed] + x
-            
+        map_embed = self.map_encoder(self._embed_map(global_map))
+
+        perception_parts = ()
+        if not self.is_blind:
+            perception_parts = (self.visual_encoder(observations),)
+
+        action_parts = ()
         if self.use_previous_action:
-            x = torch.cat(x + [self.action_embedding(prev_actions).squeeze(1)], dim=1)
-        else:
-            x = torch.cat(x, dim=1)
+            action_parts = (self.action_embedding(prev_actions).squeeze(1),)
+
+        x = torch.cat((map_embed,) + perception_parts + (goal_embed,) + action_parts, dim=1)
         x, rnn_hidden_states = self.state_encoder(x, rnn_hidden_states, masks)
         return x, rnn_hidden_states  
 
@@ -378,7 +597,10 @@ class ProposedNetOracle_Pre(Net):
             self.state_encoder = RNNStateEncoder(
                 (self._hidden_size), self._hidden_size,   #Replace 2 by number of target categories later
             )
-        self.train()
+
+        # 構築後に変わらない値なので、forward毎に辿らないようにキャッシュする
+        self._is_blind = self.visual_encoder.is_blind
+        self._num_recurrent_layers = self.state_encoder.num_recurrent_layers
 
     @property
     def output_size(self):
@@ -386,30 +608,25 @@ class ProposedNetOracle_Pre(Net):
 
     @property
     def is_blind(self):
-        return self.visual_encoder.is_blind
+        return self._is_blind
 
     @property
     def num_recurrent_layers(self):
-        return self.state_encoder.num_recurrent_layers
+        return self._num_recurrent_layers
 
     def forward(self, observations, rnn_hidden_states, prev_actions, masks):
-        x = []
-        bs = observations['rgb'].shape[0]
-        
-        if not self.is_blind:
-            perception_embed = self.visual_encoder(observations)
-            x = [perception_embed] + x
-
-        global_map_embedding = []
         global_map = observations['semMap']
-        global_map_embedding.append(self.occupancy_embedding(global_map[:, :, :, 0].type(torch.LongTensor).to(self.device).view(-1)).view(bs, 50, 50 , -1))
-        global_map_embedding = torch.cat(global_map_embedding, dim=3)
+        global_map_embedding = self.occupancy_embedding(global_map[:, :, :, 0].to(self.device, dtype=torch.long, non_blocking=True))
         map_embed = self.map_encoder(global_map_embedding)
-        x = [map_embed] + x
-            
+
+        perception_parts = ()
+        if not self.is_blind:
+            perception_parts = (self.visual_encoder(observations),)
+
+        action_parts = ()
         if self.use_previous_action:
-            x = torch.cat(x + [self.action_embedding(prev_actions).squeeze(1)], dim=1)
-        else:
-            x = torch.cat(x, dim=1)
+            action_parts = (self.action_embedding(prev_actions).squeeze(1),)
+
+        x = torch.cat((map_embed,) + perception_parts + action_parts, dim=1)
         x, rnn_hidden_states = self.state_encoder(x, rnn_hidden_states, masks)
         return x, rnn_hidden_states 
\ No newline at end of file
@@ -5,21 +5,23 @@
 # LICENSE file in the root directory of this source tree.
 
 import json
+import logging
 import os
 import time
 import pathlib
 import sys
 from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
-from einops import rearrange
 from matplotlib import pyplot as plt
 import math
+import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
-import torch_scatter
 import tqdm
+from PIL import Image
 from torch.optim.lr_scheduler import LambdaLR
 
 from habitat import Config
@@ -41,115 +43,58 @@ from utils.log_manager import LogManager
 from utils.log_writer import LogWriter
 from habitat.utils.visualizations import fog_of_war, maps
 
+try:
+    from pytorch_grad_cam import GradCAM
+    from pytorch_grad_cam.utils.image import show_cam_on_image
+    from pytorch_grad_cam.utils.model_targets import ClassifierOutputTarget
+except ImportError:
+    GradCAM = None
 
-def to_grid(coordinate_min, coordinate_max, global_map_size, position):
-    grid_size = (coordinate_max - coordinate_min) / global_map_size
-    grid_x = ((coordinate_max - position[0]) / grid_size).round()
-    grid_y = ((position[1] - coordinate_min) / grid_size).round()
-    return int(grid_x), int(grid_y)
 
+# 0-255の各値のビット数
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
-def draw_projection(image, depth, s, global_map_size, coordinate_min, coordinate_max):
-    image = torch.tensor(image).permute(2, 0, 1).unsqueeze(0)
-    depth = torch.tensor(depth).permute(2, 0, 1).unsqueeze(0)
-    spatial_locs, valid_inputs = _compute_spatial_locs(depth, s, global_map_size, coordinate_min, coordinate_max)
-    x_gp1 = _project_to_ground_plane(image, spatial_locs, valid_inputs, s)
-    
-    return x_gp1
-
-
-def _project_to_ground_plane(img_feats, spatial_locs, valid_inputs, s):
-    outh, outw = (s, s)
-    bs, f, HbyK, WbyK = img_feats.shape
-    device = img_feats.device
-    eps=-1e16
-    K = 1
-
-    # Sub-sample spatial_locs, valid_inputs according to img_feats resolution.
-    idxes_ss = ((torch.arange(0, HbyK, 1)*K).long().to(device), \
-                (torch.arange(0, WbyK, 1)*K).long().to(device))
-
-    spatial_locs_ss = spatial_locs[:, :, idxes_ss[0][:, None], idxes_ss[1]] # (bs, 2, HbyK, WbyK)
-    valid_inputs_ss = valid_inputs[:, :, idxes_ss[0][:, None], idxes_ss[1]] # (bs, 1, HbyK, WbyK)
-    valid_inputs_ss = valid_inputs_ss.squeeze(1) # (bs, HbyK, WbyK)
-    invalid_inputs_ss = ~valid_inputs_ss
-
-    # Filter out invalid spatial locations
-    invalid_spatial_locs = (spatial_locs_ss[:, 1] >= outh) | (spatial_locs_ss[:, 1] < 0 ) | \
-                        (spatial_locs_ss[:, 0] >= outw) | (spatial_locs_ss[:, 0] < 0 ) # (bs, H, W)
-
-    invalid_writes = invalid_spatial_locs | invalid_inputs_ss
-
-    # Set the idxes for all invalid locations to (0, 0)
-    spatial_locs_ss[:, 0][invalid_writes] = 0
-    spatial_locs_ss[:, 1][invalid_writes] = 0
-
-    # Weird hack to account for max-pooling negative feature values
-    invalid_writes_f = rearrange(invalid_writes, 'b h w -> b () h w').float()
-    img_feats_masked = img_feats * (1 - invalid_writes_f) + eps * invalid_writes_f
-    img_feats_masked = rearrange(img_feats_masked, 'b e h w -> b e (h w)')
-
-    # Linearize ground-plane indices (linear idx = y * W + x)
-    linear_locs_ss = spatial_locs_ss[:, 1] * outw + spatial_locs_ss[:, 0] # (bs, H, W)
-    linear_locs_ss = rearrange(linear_locs_ss, 'b h w -> b () (h w)')
-    linear_locs_ss = linear_locs_ss.expand(-1, f, -1) # .contiguous()
-
-    proj_feats, _ = torch_scatter.scatter_max(
-                        img_feats_masked,
-                        linear_locs_ss,
-                        dim=2,
-                        dim_size=outh*outw,
-                    )
-    proj_feats = rearrange(proj_feats, 'b e (h w) -> b e h w', h=outh)
-
-    # Replace invalid features with zeros
-    eps_mask = (proj_feats == eps).float()
-    proj_feats = proj_feats * (1 - eps_mask) + eps_mask * (proj_feats - eps)
 
-    return proj_feats
+def _popcount(packed, axis=None):
+    # 引く表はuint8のままにし、合計だけ64bitで取る
+    return _POPCOUNT_TABLE[packed].sum(axis=axis, dtype=np.int64)
 
 
-def _compute_spatial_locs(depth_inputs, s, global_map_size, coordinate_min, coordinate_max):
-    bs, _, imh, imw = depth_inputs.shape
-    local_scale = float(coordinate_max - coordinate_min)/float(global_map_size)
-    cx, cy = 256./2., 256./2.
-    fx = fy =  (256. / 2.) / np.tan(np.deg2rad(79. / 2.))
+def _min_ci_index(stored_ci, ci):
+    # CIが最小の保存写真のインデックス(今回のciより小さい時のみ入れ替え対象、なければ-1)
+    if len(stored_ci) > 0 and stored_ci.min() < ci:
+        return int(stored_ci.argmin())
+    return -1
 
-    #2D image coordinates
-    x    = rearrange(torch.arange(0, imw), 'w -> () () () w')
-    y    = rearrange(torch.arange(imh, 0, step=-1), 'h -> () () h ()')
-    xx   = (x - cx) / fx
-    yy   = (y - cy) / fy
 
-    # 3D real-world coordinates (in meters)
-    Z            = depth_inputs
-    X            = xx * Z
-    Y            = yy * Z
-    # valid_inputs = (depth_inputs != 0) & ((Y < 1) & (Y > -1))
-    valid_inputs = (depth_inputs != 0) & ((Y > -0.5) & (Y < 1))
+class _VisualEncoderCAMInput(torch.nn.Module):
+    # GradCAMは1つのテンソルしか渡せないので、[B, H, W, rgb+depth]を観測のdictに戻してvisual_encoderに渡す
+    def __init__(self, visual_encoder):
+        super().__init__()
+        self.visual_encoder = visual_encoder
 
-    # 2D ground projection coordinates (in meters)
-    # Note: map_scale - dimension of each grid in meters
-    # - depth/scale + (s-1)/2 since image convention is image y downward
-    # and agent is facing upwards.
-    x_gp            = ( (X / local_scale) + (s-1)/2).round().long() # (bs, 1, imh, imw)
-    y_gp            = (-(Z / local_scale) + (s-1)/2).round().long() # (bs, 1, imh, imw)
+    def forward(self, x):
+        n_rgb = self.visual_encoder._n_input_rgb
+        observations = {}
+        if n_rgb > 0:
+            observations["rgb"] = x[..., :n_rgb]
+        if self.visual_encoder._n_input_depth > 0:
+            observations["depth"] = x[..., n_rgb:]
+        return self.visual_encoder(observations)
 
-    return torch.cat([x_gp, y_gp], dim=1), valid_inputs
 
+def _write_checkpoint(checkpoint, path):
+    # 評価側がpollしている途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+    # (ドットで始まる名前はpoll_checkpoint_folderのglobに掛からない)
+    tmp_path = os.path.join(
+        os.path.dirname(path), "." + os.path.basename(path) + ".tmp"
+    )
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
 
-def rotate_tensor(x_gp, heading):
-    sin_t = torch.sin(heading.squeeze(1))
-    cos_t = torch.cos(heading.squeeze(1))
-    A = torch.zeros(x_gp.size(0), 2, 3)
-    A[:, 0, 0] = cos_t
-    A[:, 0, 1] = sin_t
-    A[:, 1, 0] = -sin_t
-    A[:, 1, 1] = cos_t
 
-    grid = F.affine_grid(A, x_gp.size())
-    rotated_x_gp = F.grid_sample(x_gp, grid)
-    return rotated_x_gp
+# current_episode_statsの列の並び
+_EPISODE_STAT_KEYS = ("reward", "exp_area", "distance", "ci", "object_num")
 
 
 # ciの閾値が単体
@@ -170,6 +115,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
         self._static_encoder = False
         self._encoder = None
+        self._checkpoint_executor = None
+        self._checkpoint_future = None
+        # 1ステップの統計量を転送するためのpinned bufferとその転送完了のevent
+        self._step_stats_buffer = None
+        self._step_stats_copied = None
+        # infoの構成(_info_schema)ごとのスカラー値へのキーの経路
+        self._info_scalar_paths = {}
         
         self._num_picture = config.TASK_CONFIG.TASK.PICTURE.NUM_PICTURE
         #撮った写真のRGB画像を保存
@@ -206,7 +158,10 @@ class PPOTrainerO(BaseRLTrainerOracle):
             device=self.device,
             object_category_embedding_size=self.config.RL.OBJECT_CATEGORY_EMBEDDING_SIZE,
             previous_action_embedding_size=self.config.RL.PREVIOUS_ACTION_EMBEDDING_SIZE,
-            use_previous_action=self.config.RL.PREVIOUS_ACTION
+            use_previous_action=self.config.RL.PREVIOUS_ACTION,
+            use_cuda_graph=ppo_cfg.use_cuda_graph,
+            compile_model=ppo_cfg.compile_model,
+            use_amp=ppo_cfg.use_amp,
         )
         
         logger.info("DEVICE: " + str(self.device))
@@ -236,17 +191,36 @@ class PPOTrainerO(BaseRLTrainerOracle):
         Returns:
             None
         """
+        # 学習中のパラメータを書き換えられないよう、CPUへのコピーを同期的に取る
+        state_dict = {
+            k: v.detach().to("cpu", copy=True)
+            for k, v in self.agent.state_dict().items()
+        }
         checkpoint = {
-            "state_dict": self.agent.state_dict(),
+            "state_dict": state_dict,
             "config": self.config,
         }
         if extra_state is not None:
             checkpoint["extra_state"] = extra_state
 
-        torch.save(
-            checkpoint, os.path.join(self.config.CHECKPOINT_FOLDER, file_name)
+        # ファイルへの書き出しはバックグラウンドで行う(同時に書き出すのは1つまで)
+        self.wait_checkpoint_saved()
+        if self._checkpoint_executor is None:
+            self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._checkpoint_future = self._checkpoint_executor.submit(
+            _write_checkpoint,
+            checkpoint,
+            os.path.join(self.config.CHECKPOINT_FOLDER, file_name),
         )
 
+    def wait_checkpoint_saved(self) -> None:
+        r"""Block until the checkpoint being written in the background,
+        if any, is on disk.
+        """
+        if self._checkpoint_future is not None:
+            self._checkpoint_future.result()
+            self._checkpoint_future = None
+
     def load_checkpoint(self, checkpoint_path: str, *args, **kwargs) -> Dict:
         r"""Load checkpoint of specified path as a dict.
 
@@ -293,41 +267,124 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
         return result
 
+    # infoの構成は学習中ほとんど変わらないので、スカラー値へのキーの経路を構成ごとに一度だけ探索して使い回す
     @classmethod
+    def _info_schema(cls, info: Dict[str, Any]) -> tuple:
+        # 入れ子のキーと値の型(配列は形も)の組。値がスカラーかどうかはこれだけで決まる
+        return tuple(
+            (
+                k,
+                cls._info_schema(v)
+                if isinstance(v, dict)
+                else (
+                    type(v),
+                    np.shape(v) if isinstance(v, (list, tuple)) else getattr(v, "shape", None),
+                ),
+            )
+            for k, v in info.items()
+            if k not in cls.METRICS_BLACKLIST
+        )
+
+    @classmethod
+    def _find_info_scalar_paths(cls, info: Dict[str, Any]) -> List:
+        paths = []
+        for k, v in info.items():
+            if k in cls.METRICS_BLACKLIST:
+                continue
+
+            if isinstance(v, dict):
+                paths.extend(
+                    (k + "." + subk, (k,) + subpath)
+                    for subk, subpath in cls._find_info_scalar_paths(v)
+                    if (k + "." + subk) not in cls.METRICS_BLACKLIST
+                )
+            elif np.size(v) == 1 and not isinstance(v, str):
+                paths.append((k, (k,)))
+
+        return paths
+
+    def _extract_scalars_from_info_cached(
+        self, info: Dict[str, Any]
+    ) -> Dict[str, float]:
+        schema = self._info_schema(info)
+        paths = self._info_scalar_paths.get(schema)
+        if paths is None:
+            paths = self._info_scalar_paths[schema] = self._find_info_scalar_paths(info)
+
+        try:
+            scalars = {}
+            for k, path in paths:
+                v = info
+                for p in path:
+                    v = v[p]
+                scalars[k] = float(v)
+        except (KeyError, TypeError, ValueError):
+            # infoの構成が変わった時は探索し直す
+            del self._info_scalar_paths[schema]
+            scalars = self._extract_scalars_from_info(info)
+        return scalars
+
     def _extract_scalars_from_infos(
-        cls, infos: List[Dict[str, Any]]
+        self, infos: List[Dict[str, Any]]
     ) -> Dict[str, List[float]]:
 
         results = defaultdict(list)
-        for i in range(len(infos)):
-            for k, v in cls._extract_scalars_from_info(infos[i]).items():
+        for info in infos:
+            for k, v in self._extract_scalars_from_info_cached(info).items():
                 results[k].append(v)
 
         return results
     
     
     def _delete_observed_target(self, n):
-        object_num = 0
-        for i in self._target_index_list[n]:
-            if self._observed_object_ci_one[n][i-maps.MAP_TARGET_POINT_INDICATOR] > self.TARGET_THRESHOLD_ONE:
-                self._target_index_list[n].remove(i)
-                object_num += 1
+        # ciが閾値以下のobjectだけを残す(反復中のremoveは要素を読み飛ばすので使わない)
+        observed = self._observed_object_ci_one[n] > self.TARGET_THRESHOLD_ONE
+        remaining = [
+            i for i in self._target_index_list[n]
+            if not observed[i-maps.MAP_TARGET_POINT_INDICATOR]
+        ]
+        object_num = len(self._target_index_list[n]) - len(remaining)
+        self._target_index_list[n] = remaining
                 
         return object_num
 
     
+    def _upload_step_stats(self, reward, exp_area, distance, ci, object_num, device):
+        # 5つの統計量を[n_envs, 5]にまとめて1回でdeviceへ転送する(列は_EPISODE_STAT_KEYSの順)
+        step_stats = np.stack([reward, exp_area, distance, ci, object_num], axis=1)
+        if device.type != "cuda":
+            return torch.from_numpy(step_stats.astype(np.float32)).to(device)
+
+        n_envs = step_stats.shape[0]
+        if self._step_stats_buffer is None or self._step_stats_buffer.shape[0] < n_envs:
+            self._step_stats_buffer = torch.empty(
+                (n_envs, len(_EPISODE_STAT_KEYS)), dtype=torch.float
+            ).pin_memory()
+            self._step_stats_copied = torch.cuda.Event()
+        else:
+            # 前のステップの転送がまだbufferを読んでいるかもしれない
+            self._step_stats_copied.synchronize()
+        buffer = self._step_stats_buffer[:n_envs]
+        buffer.numpy()[:] = step_stats
+        step_stats = buffer.to(device=device, non_blocking=True)
+        self._step_stats_copied.record()
+        return step_stats
+
     def _do_take_picture_object(self, top_down_map, fog_of_war_map, n):
         # maps.MAP_TARGET_POINT_INDICATOR(6)が写真の中に何グリッドあるかを返す
-        ci = 0
-        for i in range(len(top_down_map[n])):
-            for j in range(len(top_down_map[n][0])):
-                if (i < len(fog_of_war_map[n])) and (j < len(fog_of_war_map[n][i])):
-                    if fog_of_war_map[n][i][j] == 1:
-                        if top_down_map[n][i][j] in self._target_index_list[n]:
-                            ci += 1
-                            self._observed_object_ci_one[n][top_down_map[n][i][j]-maps.MAP_TARGET_POINT_INDICATOR]+=1
-                            #if top_down_map[n][i][j] not in self._taken_index_list[n]:
-                            #self._taken_index_list[n].append(top_down_map[n][i][j])
+        top_map = np.asarray(top_down_map[n])
+        fog_map = np.asarray(fog_of_war_map[n])
+        # top_mapとfog_mapで大きさが異なる場合は共通部分のみを見る
+        h = min(top_map.shape[0], fog_map.shape[0])
+        w = min(top_map.shape[1], fog_map.shape[1])
+        top_map = top_map[:h, :w]
+        observed = (fog_map[:h, :w] == 1) & np.isin(top_map, self._target_index_list[n])
+
+        observed_object = top_map[observed].astype(np.int64) - maps.MAP_TARGET_POINT_INDICATOR
+        ci = int(observed_object.size)
+        self._observed_object_ci_one[n] += np.bincount(
+            observed_object, minlength=self._observed_object_ci_one.shape[1]
+        )
 
         # ciが閾値を超えているobjectがあれば削除
         object_num_deleted = self._delete_observed_target(n)
@@ -335,13 +392,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
         # もし全部のobjectが削除されたら、リセット
         if len(self._target_index_list[n]) == 0:
             self._target_index_list[n] = [maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2]
-            self._observed_object_ci_one[n] = [0, 0, 0]
+            self._observed_object_ci_one[n] = 0
             
         return ci, object_num_deleted
         
 
     def _collect_rollout_step(
-        self, rollouts, current_episode_reward, current_episode_exp_area, current_episode_distance, current_episode_ci, current_episode_object_num, running_episode_stats
+        self, rollouts, current_episode_stats, running_episode_stats
     ):
         pth_time = 0.0
         env_time = 0.0
@@ -358,7 +415,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 actions,
                 actions_log_probs,
                 recurrent_hidden_states,
-            ) = self.actor_critic.act(
+            ) = self.actor_critic.act_train(
                 step_observation,
                 rollouts.recurrent_hidden_states[rollouts.step],
                 rollouts.prev_actions[rollouts.step],
@@ -369,53 +426,103 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
         t_step_env = time.time()
 
-        outputs = self.envs.step([a[0].item() for a in actions])
-        observations, rewards, dones, infos = [list(x) for x in zip(*outputs)]
+        # 1ステップにつき1回だけdeviceからactionを転送する
+        actions_cpu = actions.cpu()
+        self.envs.async_step(actions_cpu[:, 0].tolist())
 
         env_time += time.time() - t_step_env
 
+        # envが動いている間に前ステップの報酬・写真の処理を行う
         t_update_stats = time.time()
-        batch = batch_obs(observations, device=self.device)
-        
-        reward = []
-        ci = []
-        exp_area = [] # 探索済みのエリア()
-        exp_area_pre = []
-        distance = []
-        #matrics = []
-        fog_of_war_map = []
-        top_down_map = [] 
-        top_map = []
-        object_num = []
+        self._process_pending_step(
+            current_episode_stats, running_episode_stats
+        )
+        pth_time += time.time() - t_update_stats
+
+        t_step_env = time.time()
+        outputs = self.envs.wait_step()
+        # 各envの出力はタプルのまま使い、doneだけbool配列にする
+        observations, rewards, dones, infos = zip(*outputs)
+        dones = np.asarray(dones, dtype=bool)
+
+        env_time += time.time() - t_step_env
+
+        t_update_stats = time.time()
+        # 次ステップの観測はrollouts内のスロットに直接書き込む
+        batch = batch_obs(
+            observations,
+            device=self.device,
+            cache=self._obs_pin_cache,
+            out=rollouts.observations_at(rollouts.step + 1),
+        )
+
+        masks = torch.from_numpy(~dones).to(
+            device=self.device, dtype=torch.float
+        ).unsqueeze(1)
+
+        if self._static_encoder:
+            with torch.no_grad():
+                rollouts.observations["visual_features"][rollouts.step + 1].copy_(
+                    self._encoder(batch)
+                )
+
+        # 報酬はまだ計算していないので、次のステップ(またはupdate前)に書き込む
+        self._pending_step = (rollouts.rewards[rollouts.step], rewards, dones, infos)
+        rollouts.insert(
+            None,
+            recurrent_hidden_states,
+            actions,
+            actions_log_probs,
+            values,
+            None,
+            masks,
+        )
+
+        pth_time += time.time() - t_update_stats
+
+        return pth_time, env_time, self.envs.num_envs
+
+    def _process_pending_step(
+        self, current_episode_stats, running_episode_stats
+    ):
+        # 前のステップのenvの出力から報酬・写真・統計量を計算し、rolloutsの報酬のスロットに書き込む
+        if self._pending_step is None:
+            return
+        reward_slot, rewards, dones, infos = self._pending_step
+        self._pending_step = None
+
+        # 毎ステップ初期化する
+        self._observed_object_ci_one.fill(0)
+
         n_envs = self.envs.num_envs
+        # rewards[i][0] = [reward, ci, area, area_pre, distance, distance_pre]
+        # ciはTAKE_PICTUREが呼ばれていない時 -sys.float_info.max なのでfloat64で保持する
+        reward_stats = np.array([r[0][:4] for r in rewards], dtype=np.float64)
+        reward = reward_stats[:, 0].copy()
+        ci = reward_stats[:, 1].copy()
+        exp_area = reward_stats[:, 2] - reward_stats[:, 3] # 探索済みのエリア()
+        exp_area_pre = reward_stats[:, 3]
+        object_num = np.zeros(n_envs, dtype=np.float64)
+        #matrics = [r[1] for r in rewards]
+        fog_of_war_map = [info["picture_range_map"]["fog_of_war_mask"] for info in infos]
+        top_down_map = [info["picture_range_map"]["map"] for info in infos]
+        top_map = [info["top_down_map"]["map"] for info in infos]
+
+        # multi goal distanceの計算(まだ残っているtargetの分だけ足す)
+        distance_cur = np.array([r[0][4] for r in rewards], dtype=np.float64)
+        distance_pre = np.array([r[0][5] for r in rewards], dtype=np.float64)
+        target_mask = np.zeros(distance_cur.shape, dtype=bool)
         for i in range(n_envs):
-            reward.append(rewards[i][0][0])
-            ci.append(rewards[i][0][1])
-            exp_area.append(rewards[i][0][2]-rewards[i][0][3])
-            exp_area_pre.append(rewards[i][0][3])
-            #matrics.append(rewards[i][1])
-            object_num.append(0)
-            fog_of_war_map.append(infos[i]["picture_range_map"]["fog_of_war_mask"])
-            top_down_map.append(infos[i]["picture_range_map"]["map"])
-            top_map.append(infos[i]["top_down_map"]["map"])
-            
-            # multi goal distanceの計算
-            dis = 0.0
-            dis_pre = 0
-            for j in self._target_index_list[i]:
-                dis_pre += rewards[i][0][5][j-maps.MAP_TARGET_POINT_INDICATOR]
-                dis += rewards[i][0][4][j-maps.MAP_TARGET_POINT_INDICATOR]
-            
-            reward[i] += dis_pre - dis
-            distance.append(dis_pre - dis)
-            
+            target_mask[i, np.asarray(self._target_index_list[i], dtype=np.int64) - maps.MAP_TARGET_POINT_INDICATOR] = True
+        distance = np.where(target_mask, distance_pre - distance_cur, 0.0).sum(axis=1)
+        reward += distance
         
-        for n in range(len(observations)):
+        for n in range(n_envs):
             #TAKE_PICTUREが呼び出されたかを検証
             if ci[n] != -sys.float_info.max:
-                # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)とかぶっているkを保存
-                cover_list = [] 
                 picture_range_map = self._create_picture_range_map(top_down_map[n], fog_of_war_map[n])
+                # 写真を撮った範囲(==1)をビット列に詰めて保存し、被りの計算に使う
+                picture_mask = np.packbits(picture_range_map == 1)
                 
                 ci[n], object_num[n] = self._do_take_picture_object(top_map, fog_of_war_map, n)
                 
@@ -424,25 +531,19 @@ class PPOTrainerO(BaseRLTrainerOracle):
                
                 # p_kのそれぞれのpicture_range_mapのリスト
                 pre_fog_of_war_map = [sublist[1] for sublist in self._taken_picture_list[n]]
+                stored_ci = np.array([sublist[0] for sublist in self._taken_picture_list[n]], dtype=np.float64)
                     
-                # それぞれと閾値より被っているか計算
-                idx = -1
-                min_ci = ci[n]
-                for k in range(len(pre_fog_of_war_map)):
-                    # 閾値よりも被っていたらcover_listにkを追加
-                    if self._check_percentage_of_fog(picture_range_map, pre_fog_of_war_map[k]) == True:
-                        cover_list.append(k)
-                            
-                    #ciの最小値の写真を探索(１つも被っていない時用)
-                    if min_ci < self._taken_picture_list[n][idx][0]:
-                        idx = k
-                        min_ci = self._taken_picture_list[n][idx][0]
+                # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)と閾値より被っているkを保存
+                cover_list = self._find_covered_pictures(picture_range_map, picture_mask, self._taken_picture_list[n])
+                        
+                #ciの最小値の写真を探索(１つも被っていない時用)
+                idx = _min_ci_index(stored_ci, ci[n])
                         
                 # 今までの写真と多くは被っていない時
                 if len(cover_list) == 0:
                     #範囲が多く被っていなくて、self._num_picture回未満写真を撮っていたらそのまま保存
                     if len(self._taken_picture_list[n]) != self._num_picture:
-                        self._taken_picture_list[n].append([ci[n], picture_range_map])
+                        self._taken_picture_list[n].append([ci[n], picture_range_map, picture_mask])
                         #self._taken_picture[n].append(observations[n]["rgb"])
                         reward[n] += ci[n]
                             
@@ -451,7 +552,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                         # 今回の写真が保存してある写真の１つでもCIが高かったらCIが最小の保存写真と入れ替え
                         if idx != -1:
                             ci_pre = self._taken_picture_list[n][idx][0]
-                            self._taken_picture_list[n][idx] = [ci[n], picture_range_map]
+                            self._taken_picture_list[n][idx] = [ci[n], picture_range_map, picture_mask]
                             #self._taken_picture[n][idx] = observations[n]["rgb"]   
                             reward[n] += (ci[n] - ci_pre)     
                             ci[n] -= ci_pre
@@ -460,18 +561,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
                         
                 # 1つとでも多く被っていた時    
                 else:
-                    min_idx = -1
-                    min_ci_k = 1000
                     # 多く被った写真のうち、ciが最小のものを計算
-                    for k in range(len(cover_list)):
-                        idx_k = cover_list[k]
-                        if self._taken_picture_list[n][idx_k][0] < min_ci_k:
-                            min_ci_k = self._taken_picture_list[n][idx_k][0]
-                            min_idx = idx_k
+                    min_idx = cover_list[int(stored_ci[cover_list].argmin())]
+                    min_ci_k = stored_ci[min_idx]
                                 
                     # 被った割合分小さくなったCIでも保存写真の中の最小のCIより大きかったら交換
                     if self._compareWithChangedCI(picture_range_map, pre_fog_of_war_map, cover_list, ci[n], min_ci_k, min_idx) == True:
-                        self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map]
+                        self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map, picture_mask]
                         #self._taken_picture[n][min_idx] = observations[n]["rgb"]   
                         reward[n] += (ci[n] - min_ci_k)  
                         ci[n] -= min_ci_k
@@ -480,64 +576,44 @@ class PPOTrainerO(BaseRLTrainerOracle):
             else:
                 ci[n] = 0.0
             
-        reward = torch.tensor(
-            reward, dtype=torch.float, device=current_episode_reward.device
-        ).unsqueeze(1)
-        exp_area = torch.tensor(
-           exp_area, dtype=torch.float, device=current_episode_reward.device
-        ).unsqueeze(1)
-        ci = torch.tensor(
-           ci, dtype=torch.float, device=current_episode_reward.device
-        ).unsqueeze(1)
-        distance = torch.tensor(
-           distance, dtype=torch.float, device=current_episode_reward.device
-        ).unsqueeze(1)
-        object_num = torch.tensor(
-           object_num, dtype=torch.float, device=current_episode_reward.device
-        ).unsqueeze(1)
+        # 5つの統計量をまとめて1回でdeviceへ転送する
+        step_stats = self._upload_step_stats(
+            reward, exp_area, distance, ci, object_num, current_episode_stats.device
+        )
         
 
-        masks = torch.tensor(
-            [[0.0] if done else [1.0] for done in dones],
-            dtype=torch.float,
-            device=current_episode_reward.device,
-        )
+        masks = torch.from_numpy(~dones).to(
+            device=current_episode_stats.device, dtype=torch.float
+        ).unsqueeze(1)
         
         # episode ended
-        for n in range(len(observations)):
-            if masks[n].item() == 0.0:
-                """
-                for i in range(self._num_picture):
-                    if i < len(self._taken_picture_list[n]):
-                        self.take_picture_writer.write(str(self._taken_picture_list[n][i][0]))
-                        self.picture_position_writer.write(str(self._taken_picture_list[n][i][1][0]) + "," + str(self._taken_picture_list[n][i][1][1]) + "," + str(self._taken_picture_list[n][i][1][2]))
-                    else:
-                        self.take_picture_writer.write(" ")
-                        self.picture_position_writer.write(" ")
-                        
-                self.take_picture_writer.writeLine()
-                self.picture_position_writer.writeLine()
-                """
-                #self._taken_picture[n] = []
-                self._taken_picture_list[n] = []
-                self._target_index_list[n] = [maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2]
-                
+        for n in np.flatnonzero(dones):
+            """
+            for i in range(self._num_picture):
+                if i < len(self._taken_picture_list[n]):
+                    self.take_picture_writer.write(str(self._taken_picture_list[n][i][0]))
+                    self.picture_position_writer.write(str(self._taken_picture_list[n][i][1][0]) + "," + str(self._taken_picture_list[n][i][1][1]) + "," + str(self._taken_picture_list[n][i][1][2]))
+                else:
+                    self.take_picture_writer.write(" ")
+                    self.picture_position_writer.write(" ")
+                    
+            self.take_picture_writer.writeLine()
+            self.picture_position_writer.writeLine()
+            """
+            #self._taken_picture[n] = []
+            self._taken_picture_list[n] = []
+            self._target_index_list[n] = [maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2]
+            
 
-        current_episode_reward += reward
-        running_episode_stats["reward"] += (1 - masks) * current_episode_reward
-        current_episode_exp_area += exp_area
-        running_episode_stats["exp_area"] += (1 - masks) * current_episode_exp_area
-        current_episode_distance += distance
-        running_episode_stats["distance"] += (1 - masks) * current_episode_distance
-        current_episode_ci += ci
-        running_episode_stats["ci"] += (1 - masks) * current_episode_ci
-        current_episode_object_num += object_num
-        running_episode_stats["object_num"] += (1 - masks) * current_episode_object_num
+        current_episode_stats += step_stats
+        ended_episode_stats = (1 - masks) * current_episode_stats
+        for j, k in enumerate(_EPISODE_STAT_KEYS):
+            running_episode_stats[k] += ended_episode_stats[:, j:j+1]
         running_episode_stats["count"] += 1 - masks
 
         for k, v in self._extract_scalars_from_infos(infos).items():
             v = torch.tensor(
-                v, dtype=torch.float, device=current_episode_reward.device
+                v, dtype=torch.float, device=current_episode_stats.device
             ).unsqueeze(1)
             if k not in running_episode_stats:
                 running_episode_stats[k] = torch.zeros_like(
@@ -547,29 +623,9 @@ class PPOTrainerO(BaseRLTrainerOracle):
             running_episode_stats[k] += (1 - masks) * v
 
     
-        current_episode_reward *= masks
-        current_episode_exp_area *= masks
-        current_episode_distance *= masks
-        current_episode_ci *= masks
-        current_episode_object_num *= masks
+        current_episode_stats *= masks
 
-        if self._static_encoder:
-            with torch.no_grad():
-                batch["visual_features"] = self._encoder(batch)
-
-        rollouts.insert(
-            batch,
-            recurrent_hidden_states,
-            actions,
-            actions_log_probs,
-            values,
-            reward,
-            masks,
-        )
-
-        pth_time += time.time() - t_update_stats
-
-        return pth_time, env_time, self.envs.num_envs
+        reward_slot.copy_(step_stats[:, 0:1])
 
     def _update_agent(self, ppo_cfg, rollouts):
         t_update_model = time.time()
@@ -631,7 +687,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
             #self._taken_picture.append([])
             self._taken_picture_list.append([])
             self._target_index_list.append([maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2])
-            self._observed_object_ci_one.append([0, 0, 0])
+        self._observed_object_ci_one = np.zeros((self.envs.num_envs, 3), dtype=np.int64)
 
         ppo_cfg = self.config.RL.PPO
         self.device = (
@@ -654,14 +710,21 @@ class PPOTrainerO(BaseRLTrainerOracle):
             self.envs.observation_spaces[0],
             self.envs.action_spaces[0],
             ppo_cfg.hidden_size,
+            goal_sensor_uuid=self.config.TASK_CONFIG.TASK.GOAL_SENSOR_UUID,
         )
         rollouts.to(self.device)
 
+        # 観測をpinned memory経由で非同期にGPUへ転送するためのバッファ
+        self._obs_pin_cache = {}
+        # envの実行と並行して処理する、報酬を計算していないステップ
+        self._pending_step = None
         observations = self.envs.reset()
-        batch = batch_obs(observations, device=self.device)
-
-        for sensor in rollouts.observations:
-            rollouts.observations[sensor][0].copy_(batch[sensor])
+        batch = batch_obs(
+            observations,
+            device=self.device,
+            cache=self._obs_pin_cache,
+            out=rollouts.observations_at(0),
+        )
 
         # batch and observations may contain shared PyTorch CUDA
         # tensors.  We must explicitly clear them here otherwise
@@ -669,18 +732,15 @@ class PPOTrainerO(BaseRLTrainerOracle):
         batch = None
         observations = None
 
-        current_episode_reward = torch.zeros(self.envs.num_envs, 1, device=self.device)
-        current_episode_exp_area = torch.zeros(self.envs.num_envs, 1, device=self.device)
-        current_episode_distance = torch.zeros(self.envs.num_envs, 1, device=self.device)
-        current_episode_ci = torch.zeros(self.envs.num_envs, 1, device=self.device)
-        current_episode_object_num = torch.zeros(self.envs.num_envs, 1, device=self.device)
+        # 列は_EPISODE_STAT_KEYSの順 [reward, exp_area, distance, ci, object_num]
+        current_episode_stats = torch.zeros(self.envs.num_envs, len(_EPISODE_STAT_KEYS), device=self.device)
         running_episode_stats = dict(
-            count=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
-            reward=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
-            exp_area=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
-            distance=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
-            ci=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
-            object_num=torch.zeros(self.envs.num_envs, 1, device=current_episode_reward.device),
+            count=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
+            reward=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
+            exp_area=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
+            distance=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
+            ci=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
+            object_num=torch.zeros(self.envs.num_envs, 1, device=current_episode_stats.device),
         )
         window_episode_stats = defaultdict(
             lambda: deque(maxlen=ppo_cfg.reward_window_size)
@@ -712,21 +772,24 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 if (step + update*ppo_cfg.num_steps) % 500 == 0:
                     print("STEP: " + str(step + update*ppo_cfg.num_steps))
                     
-                # 毎ステップ初期化する
-                for n in range(self.envs.num_envs):
-                    self._observed_object_ci_one[n] = [0, 0, 0]
-                    
                 (
                     delta_pth_time,
                     delta_env_time,
                     delta_steps,
                 ) = self._collect_rollout_step(
-                    rollouts, current_episode_reward, current_episode_exp_area, current_episode_distance, current_episode_ci, current_episode_object_num, running_episode_stats
+                    rollouts, current_episode_stats, running_episode_stats
                 )
                 pth_time += delta_pth_time
                 env_time += delta_env_time
                 count_steps += delta_steps
 
+            # 最後のステップの報酬を書き込んでからupdateする
+            t_update_stats = time.time()
+            self._process_pending_step(
+                current_episode_stats, running_episode_stats
+            )
+            pth_time += time.time() - t_update_stats
+
             (
                 delta_pth_time,
                 value_loss,
@@ -747,72 +810,72 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 for k, v in window_episode_stats.items()
             }
             deltas["count"] = max(deltas["count"], 1.0)
+            deltas_count = deltas["count"]
                 
             #csv
-            reward_logger.writeLine(str(count_steps) + "," + str(deltas["reward"] / deltas["count"]))
-            learning_rate_logger.writeLine(str(count_steps) + "," + str(lr_scheduler._last_lr[0]))
+            reward_logger.writeRow([count_steps, deltas["reward"] / deltas_count])
+            learning_rate_logger.writeRow([count_steps, lr_scheduler._last_lr[0]])
 
             total_actions = rollouts.actions.shape[0] * rollouts.actions.shape[1]
-            total_found_actions = int(torch.sum(rollouts.actions == 0).cpu().numpy())
-            total_forward_actions = int(torch.sum(rollouts.actions == 1).cpu().numpy())
-            total_left_actions = int(torch.sum(rollouts.actions == 2).cpu().numpy())
-            total_right_actions = int(torch.sum(rollouts.actions == 3).cpu().numpy())
-            total_look_up_actions = int(torch.sum(rollouts.actions == 4).cpu().numpy())
-            total_look_down_actions = int(torch.sum(rollouts.actions == 5).cpu().numpy())
+            # 行動ごとの回数を1回の転送でまとめて取得する
+            (
+                total_found_actions,
+                total_forward_actions,
+                total_left_actions,
+                total_right_actions,
+                total_look_up_actions,
+                total_look_down_actions,
+            ) = torch.bincount(rollouts.actions.flatten().long(), minlength=6)[:6].tolist()
             assert total_actions == (total_found_actions + total_forward_actions + 
                 total_left_actions + total_right_actions + total_look_up_actions + 
                 total_look_down_actions
             )
                 
             # csv
-            action_logger.writeLine(
-                str(count_steps) + "," + str(total_found_actions/total_actions) + ","
-                + str(total_forward_actions/total_actions) + "," + str(total_left_actions/total_actions) + ","
-                + str(total_right_actions/total_actions) + "," + str(total_look_up_actions/total_actions) + ","
-                + str(total_look_down_actions/total_actions)
-            )
+            action_logger.writeRow([
+                count_steps, total_found_actions/total_actions,
+                total_forward_actions/total_actions, total_left_actions/total_actions,
+                total_right_actions/total_actions, total_look_up_actions/total_actions,
+                total_look_down_actions/total_actions,
+            ])
             metrics = {
-                k: v / deltas["count"]
+                k: v / deltas_count
                 for k, v in deltas.items()
                 if k not in {"reward", "count"}
             }
 
             if len(metrics) > 0:
-                logger.info("COUNT: " + str(deltas["count"]))
-                logger.info("CI:" + str(metrics["ci"]))
-                logger.info("OBJECT_NUM: " + str(metrics["object_num"]))
-                logger.info("REWARD: " + str(deltas["reward"] / deltas["count"]))
-                metrics_logger.writeLine(str(count_steps) + "," +str(metrics["ci"]) + "," + str(metrics["exp_area"]) + "," + str(metrics["distance"]) + "," + str(metrics["raw_metrics.agent_path_length"]) + "," + str(metrics["object_num"]))
-                    
-                logger.info(metrics)
+                metrics_logger.writeRow([count_steps, metrics["ci"], metrics["exp_area"], metrics["distance"], metrics["raw_metrics.agent_path_length"], metrics["object_num"]])
+                
+                # ログに出さない時はdictの文字列化もしない
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        f"COUNT: {deltas_count}\n"
+                        f"CI:{metrics['ci']}\n"
+                        f"OBJECT_NUM: {metrics['object_num']}\n"
+                        f"REWARD: {deltas['reward'] / deltas_count}\n"
+                        f"{metrics}"
+                    )
             
-            loss_logger.writeLine(str(count_steps) + "," + str(value_loss) + "," + str(action_loss))
+            loss_logger.writeRow([count_steps, value_loss, action_loss])
                 
 
             # log stats
-            if update > 0 and update % self.config.LOG_INTERVAL == 0:
-                logger.info(
-                    "update: {}\tfps: {:.3f}\t".format(
-                        update, count_steps / (time.time() - t_start)
-                    )
-                )
-
-                logger.info(
-                    "update: {}\tenv-time: {:.3f}s\tpth-time: {:.3f}s\t"
-                    "frames: {}".format(
-                        update, env_time, pth_time, count_steps
-                    )
+            if (
+                update > 0
+                and update % self.config.LOG_INTERVAL == 0
+                and logger.isEnabledFor(logging.INFO)
+            ):
+                window_stats = "  ".join(
+                    f"{k}: {v / deltas_count:.3f}"
+                    for k, v in deltas.items()
+                    if k != "count"
                 )
-
                 logger.info(
-                    "Average window size: {}  {}".format(
-                        len(window_episode_stats["count"]),
-                        "  ".join(
-                            "{}: {:.3f}".format(k, v / deltas["count"])
-                            for k, v in deltas.items()
-                            if k != "count"
-                        ),
-                    )
+                    f"update: {update}\tfps: {count_steps / (time.time() - t_start):.3f}\t\n"
+                    f"update: {update}\tenv-time: {env_time:.3f}s\tpth-time: {pth_time:.3f}s\t"
+                    f"frames: {count_steps}\n"
+                    f"Average window size: {len(window_episode_stats['count'])}  {window_stats}"
                 )
 
             # checkpoint model
@@ -821,90 +884,62 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     f"ckpt.{count_checkpoints}.pth", dict(step=count_steps)
                 )
                 count_checkpoints += 1
+                # ログはcheckpointごとにファイルへ書き出す
+                self.log_manager.flushAll()
 
+        self.log_manager.closeAll()
+        self.wait_checkpoint_saved()
         self.envs.close()
             
             
     # 写真を撮った範囲のマップを作成
     def _create_picture_range_map(self, top_down_map, fog_of_war_map):
         # 0: 壁など, 1: 写真を撮った範囲, 2: 巡回可能領域
-        picture_range_map = np.zeros_like(top_down_map)
-        for i in range(len(top_down_map)):
-            for j in range(len(top_down_map[0])):
-                if top_down_map[i][j] != 0:
-                    if fog_of_war_map[i][j] == 1:
-                        picture_range_map[i][j] = 1
-                    else:
-                        picture_range_map[i][j] = 2
+        top_down_map = np.asarray(top_down_map)
+        fog_of_war_map = np.asarray(fog_of_war_map)
+        # 値は{0,1,2}だけなのでuint8で持つ
+        picture_range_map = np.zeros(top_down_map.shape, dtype=np.uint8)
+        valid = top_down_map != 0
+        picture_range_map[valid] = np.where(fog_of_war_map[valid] == 1, 1, 2)
                         
         return picture_range_map
             
-    # fog_mapがpre_fog_mapと閾値以上の割合で被っているか
-    def _check_percentage_of_fog(self, fog_map, pre_fog_map, threshold=0.25):
-        y = len(fog_map)
-        x = len(fog_map[0])
-        
-        num = 0 #fog_mapのMAP_VALID_POINTの数
-        num_covered = 0 #pre_fog_mapと被っているグリッド数
-        
-        y_pre = len(pre_fog_map)
-        x_pre = len(pre_fog_map[0])
+    # fog_mapと閾値以上の割合で被っている保存写真のインデックスのリスト
+    # picture_maskと保存写真の3番目の要素はnp.packbitsで詰めた撮影範囲
+    def _find_covered_pictures(self, fog_map, picture_mask, taken_picture_list, threshold=0.25):
+        num = _popcount(picture_mask) #fog_mapのMAP_VALID_POINTの数
+        # 大きさが異なるmapは被っていないとみなす
+        same_shape = [
+            k for k, taken_picture in enumerate(taken_picture_list)
+            if np.shape(taken_picture[1]) == np.shape(fog_map)
+        ]
+        if num == 0 or len(same_shape) == 0:
+            return []
         
-        
-        if (x==x_pre) and (y==y_pre):
-            for i in range(y):
-                for j in range(x):
-                    # fog_mapで写真を撮っている範囲の時
-                    if fog_map[i][j] == 1:
-                        num += 1
-                        # fogとpre_fogがかぶっている時
-                        if pre_fog_map[i][j] == 1:
-                            num_covered += 1
-                            
-            if num == 0:
-                per = 0.0
-            else:
-                per = num_covered / num
-            
-            if per < threshold:
-                return False
-            else:
-                return True
-        else:
-            False
+        pre_masks = np.stack([taken_picture_list[k][2] for k in same_shape])
+        num_covered = _popcount(pre_masks & picture_mask, axis=1) #pre_fog_mapと被っているグリッド数
+        return [same_shape[k] for k in np.flatnonzero(num_covered / num >= threshold)]
         
     # fog_mapがidx以外のpre_fog_mapと被っている割合を算出
     def _cal_rate_of_fog_other(self, fog_map, pre_fog_of_war_map_list, cover_list, idx):
-        y = len(fog_map)
-        x = len(fog_map[0])
+        # idx以外の被っているmap
+        other_idxs = [map_idx for map_idx in cover_list if map_idx != idx]
+        if len(other_idxs) == 0:
+            return 0.0
         
-        num = 0.0 #fog_mapのMAP_VALID_POINTの数
-        num_covered = 0.0 #pre_fog_mapのどれかと被っているグリッド数
-        
-        for i in range(y):
-            for j in range(x):
-                # fog_mapで写真を撮っている範囲の時
-                if fog_map[i][j] == 1:
-                    num += 1
-                    
-                    # 被っているmapを検査する
-                    for k in range(len(cover_list)):
-                        map_idx = cover_list[k]
-                        if map_idx == idx:
-                            continue
-                        
-                        pre_map = pre_fog_of_war_map_list[map_idx]
-                        # fogとpre_fogがかぶっている時
-                        if pre_map[i][j] == 1:
-                            num_covered += 1
-                            break
-                        
+        # fog_mapで写真を撮っている範囲
+        fog_mask = np.asarray(fog_map) == 1
+        num = np.count_nonzero(fog_mask) #fog_mapのMAP_VALID_POINTの数
         if num == 0:
-            rate = 0.0
-        else:
-            rate = num_covered / num
+            return 0.0
         
-        return rate
+        # idx以外の被っているmapのどれかと被っている範囲
+        covered = np.logical_or.reduce(
+            np.stack([pre_fog_of_war_map_list[map_idx] for map_idx in other_idxs]) == 1, axis=0
+        )
+        
+        num_covered = np.count_nonzero(fog_mask & covered) #pre_fog_mapのどれかと被っているグリッド数
+        return num_covered / num
     
     
     def _compareWithChangedCI(self, picture_range_map, pre_fog_of_war_map_list, cover_list, ci, pre_ci, idx):
@@ -966,38 +1001,30 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
         self.agent.load_state_dict(ckpt_dict["state_dict"])
         self.actor_critic = self.agent.actor_critic
+        if config.EVAL.USE_BF16:
+            self.actor_critic.to_inference(torch.bfloat16)
         
         self._taken_picture = []
         self._taken_picture_list = []
         self._target_index_list = []
         self._taken_index_list = []
         # 1回のCIを保存
-        self._observed_object_ci_one = []
+        self._observed_object_ci_one = np.zeros((self.envs.num_envs, 3), dtype=np.int64)
         
         for i in range(self.envs.num_envs):
             self._taken_picture.append([])
             self._taken_picture_list.append([])
             self._target_index_list.append([maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2])
             self._taken_index_list.append([])
-            self._observed_object_ci_one.append([0, 0, 0])
         
         observations = self.envs.reset()
-        batch = batch_obs(observations, device=self.device)
+        # 観測はpinned bufferに詰めて使い回し、非同期でdeviceへ転送する
+        obs_pin_cache = {}
+        batch = batch_obs(observations, device=self.device, cache=obs_pin_cache)
 
-        current_episode_reward = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_exp_area = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_distance = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_ci = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_object_num = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
+        # 列は_EPISODE_STAT_KEYSの順 [reward, exp_area, distance, ci, object_num]
+        current_episode_stats = torch.zeros(
+            self.envs.num_envs, len(_EPISODE_STAT_KEYS), device=self.device
         )
         
         test_recurrent_hidden_states = torch.zeros(
@@ -1015,11 +1042,20 @@ class PPOTrainerO(BaseRLTrainerOracle):
         stats_episodes = dict()  # dict of dicts that stores stats per episode
         raw_metrics_episodes = dict()
 
+        # 動画のフレームは別スレッドで合成し、エピソードが終わるまではFutureのまま持つ
         rgb_frames = [
             [] for _ in range(self.config.NUM_PROCESSES)
-        ]  # type: List[List[np.ndarray]]
+        ]  # type: List[List[Future]]
+        frame_pool = None
+        # 撮った写真の保存先は最初に1回だけ作る
+        picture_dir_name = "./taken_picture/" + date
         if len(self.config.VIDEO_OPTION) > 0:
             os.makedirs(self.config.VIDEO_DIR+"/"+date, exist_ok=True)
+            os.makedirs(picture_dir_name, exist_ok=True)
+            frame_pool = ThreadPoolExecutor(max_workers=1)
+        # 撮った写真の保存用
+        picture_pool = ThreadPoolExecutor(max_workers=4)
+        picture_futures = []
 
         pbar = tqdm.tqdm(total=self.config.TEST_EPISODE_COUNT)
         self.actor_critic.eval()
@@ -1029,13 +1065,14 @@ class PPOTrainerO(BaseRLTrainerOracle):
         ):
             current_episodes = self.envs.current_episodes()
 
-            with torch.no_grad():
+            # 評価では勾配もversion counterも不要なのでinference_modeで推論する
+            with torch.inference_mode():
                 (
                     _,
                     actions,
                     _,
                     test_recurrent_hidden_states,
-                ) = self.actor_critic.act(
+                ) = self.actor_critic.act_inference(
                     batch,
                     test_recurrent_hidden_states,
                     prev_actions,
@@ -1045,61 +1082,50 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
                 prev_actions.copy_(actions)
 
-            outputs = self.envs.step([a[0].item() for a in actions])
+            # 1ステップにつき1回だけdeviceからactionを転送する
+            actions_cpu = actions.cpu()
+            outputs = self.envs.step(actions_cpu[:, 0].tolist())
  
-            observations, rewards, dones, infos = [
-                list(x) for x in zip(*outputs)
-            ]
-            batch = batch_obs(observations, device=self.device)
+            # 各envの出力はタプルのまま使い、doneだけbool配列にする
+            observations, rewards, dones, infos = zip(*outputs)
+            dones = np.asarray(dones, dtype=bool)
+            batch = batch_obs(observations, device=self.device, cache=obs_pin_cache)
             
-            not_done_masks = torch.tensor(
-                [[0.0] if done else [1.0] for done in dones],
-                dtype=torch.float,
-                device=self.device,
-            )
+            not_done_masks = torch.from_numpy(~dones).to(
+                device=self.device, dtype=torch.float
+            ).unsqueeze(1)
             
-            for n in range(self.envs.num_envs):
-                self._observed_object_ci_one[n] = [0, 0, 0] 
+            self._observed_object_ci_one.fill(0)
             
-            reward = []
-            ci = []
-            exp_area = [] # 探索済みのエリア()
-            exp_area_pre = []
-            distance = []
-            #matrics = []
-            fog_of_war_map = []
-            top_down_map = [] 
-            top_map = []
-            object_num = []
             n_envs = self.envs.num_envs
+            # rewards[i][0] = [reward, ci, area, area_pre, distance, distance_pre]
+            # ciはTAKE_PICTUREが呼ばれていない時 -sys.float_info.max なのでfloat64で保持する
+            reward_stats = np.array([r[0][:4] for r in rewards], dtype=np.float64)
+            reward = reward_stats[:, 0].copy()
+            ci = reward_stats[:, 1].copy()
+            exp_area = reward_stats[:, 2] - reward_stats[:, 3] # 探索済みのエリア()
+            exp_area_pre = reward_stats[:, 3]
+            object_num = np.zeros(n_envs, dtype=np.float64)
+            #matrics = [r[1] for r in rewards]
+            fog_of_war_map = [info["picture_range_map"]["fog_of_war_mask"] for info in infos]
+            top_down_map = [info["picture_range_map"]["map"] for info in infos]
+            top_map = [info["top_down_map"]["map"] for info in infos]
             
+            # multi goal distanceの計算(まだ残っているtargetの分だけ足す)
+            distance_cur = np.array([r[0][4] for r in rewards], dtype=np.float64)
+            distance_pre = np.array([r[0][5] for r in rewards], dtype=np.float64)
+            target_mask = np.zeros(distance_cur.shape, dtype=bool)
             for i in range(n_envs):
-                reward.append(rewards[i][0][0])
-                ci.append(rewards[i][0][1])
-                exp_area.append(rewards[i][0][2]-rewards[i][0][3])
-                exp_area_pre.append(rewards[i][0][3])
-                #matrics.append(rewards[i][1])
-                fog_of_war_map.append(infos[i]["picture_range_map"]["fog_of_war_mask"])
-                top_down_map.append(infos[i]["picture_range_map"]["map"])
-                top_map.append(infos[i]["top_down_map"]["map"])
-                object_num.append(0)
-                
-                # multi goal distanceの計算
-                dis = 0.0
-                dis_pre = 0
-                for j in self._target_index_list[i]:
-                    dis_pre += rewards[i][0][5][j-maps.MAP_TARGET_POINT_INDICATOR]
-                    dis += rewards[i][0][4][j-maps.MAP_TARGET_POINT_INDICATOR]
-            
-                reward[i] += dis_pre - dis
-                distance.append(dis_pre - dis)
+                target_mask[i, np.asarray(self._target_index_list[i], dtype=np.int64) - maps.MAP_TARGET_POINT_INDICATOR] = True
+            distance = np.where(target_mask, distance_pre - distance_cur, 0.0).sum(axis=1)
+            reward += distance
             
             for n in range(len(observations)):
             #TAKE_PICTUREが呼び出されたかを検証
                 if ci[n] != -sys.float_info.max:
-                    # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)とかぶっているkを保存
-                    cover_list = [] 
                     picture_range_map = self._create_picture_range_map(top_down_map[n], fog_of_war_map[n])
+                    # 写真を撮った範囲(==1)はステップごとに1回だけ求め、ビット列に詰めて被りの計算に使う
+                    picture_mask = np.packbits(picture_range_map == 1)
                     ci[n], object_num[n] = self._do_take_picture_object(top_map, fog_of_war_map, n)
                     
                     if ci[n] == 0:
@@ -1107,25 +1133,19 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     
                     # p_kのそれぞれのpicture_range_mapのリスト
                     pre_fog_of_war_map = [sublist[1] for sublist in self._taken_picture_list[n]]
+                    stored_ci = np.array([sublist[0] for sublist in self._taken_picture_list[n]], dtype=np.float64)
                         
-                    # それぞれと閾値より被っているか計算
-                    idx = -1
-                    min_ci = ci[n]
-                    for k in range(len(pre_fog_of_war_map)):
-                        # 閾値よりも被っていたらcover_listにkを追加
-                        if self._check_percentage_of_fog(picture_range_map, pre_fog_of_war_map[k]) == True:
-                            cover_list.append(k)
-                                
-                        #ciの最小値の写真を探索(１つも被っていない時用)
-                        if min_ci < self._taken_picture_list[n][idx][0]:
-                            idx = k
-                            min_ci = self._taken_picture_list[n][idx][0]
+                    # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)と閾値より被っているkを保存
+                    cover_list = self._find_covered_pictures(picture_range_map, picture_mask, self._taken_picture_list[n])
+                    
+                    #ciの最小値の写真を探索(１つも被っていない時用)
+                    idx = _min_ci_index(stored_ci, ci[n])
                             
                     # 今までの写真と多くは被っていない時
                     if len(cover_list) == 0:
                         #範囲が多く被っていなくて、self._num_picture回未満写真を撮っていたらそのまま保存
                         if len(self._taken_picture_list[n]) != self._num_picture:
-                            self._taken_picture_list[n].append([ci[n], picture_range_map])
+                            self._taken_picture_list[n].append([ci[n], picture_range_map, picture_mask])
                             if len(self.config.VIDEO_OPTION) > 0:
                                 self._taken_picture[n].append(observations[n]["rgb"])
                             reward[n] += ci[n]
@@ -1135,7 +1155,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                             # 今回の写真が保存してある写真の１つでもCIが高かったらCIが最小の保存写真と入れ替え
                             if idx != -1:
                                 ci_pre = self._taken_picture_list[n][idx][0]
-                                self._taken_picture_list[n][idx] = [ci[n], picture_range_map]
+                                self._taken_picture_list[n][idx] = [ci[n], picture_range_map, picture_mask]
                                 if len(self.config.VIDEO_OPTION) > 0:
                                     self._taken_picture[n][idx] = observations[n]["rgb"]   
                                 reward[n] += (ci[n] - ci_pre) 
@@ -1145,18 +1165,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
                             
                     # 1つとでも多く被っていた時    
                     else:
-                        min_idx = -1
-                        min_ci_k = 1000
                         # 多く被った写真のうち、ciが最小のものを計算
-                        for k in range(len(cover_list)):
-                            idx_k = cover_list[k]
-                            if self._taken_picture_list[n][idx_k][0] < min_ci_k:
-                                min_ci_k = self._taken_picture_list[n][idx_k][0]
-                                min_idx = idx_k
+                        min_idx = cover_list[int(stored_ci[cover_list].argmin())]
+                        min_ci_k = stored_ci[min_idx]
                                     
                         # 被った割合分小さくなったCIでも保存写真の中の最小のCIより大きかったら交換
                         if self._compareWithChangedCI(picture_range_map, pre_fog_of_war_map, cover_list, ci[n], min_ci_k, min_idx) == True:
-                            self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map]
+                            self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map, picture_mask]
                             if len(self.config.VIDEO_OPTION) > 0:
                                 self._taken_picture[n][min_idx] = observations[n]["rgb"]   
                             reward[n] += (ci[n] - min_ci_k)  
@@ -1166,27 +1181,12 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 else:
                     ci[n] = 0.0
                 
-            reward = torch.tensor(
-                reward, dtype=torch.float, device=self.device
-            ).unsqueeze(1)
-            exp_area = torch.tensor(
-                exp_area, dtype=torch.float, device=self.device
-            ).unsqueeze(1)
-            distance = torch.tensor(
-                distance, dtype=torch.float, device=self.device
-            ).unsqueeze(1)
-            ci= torch.tensor(
-                ci, dtype=torch.float, device=self.device
-            ).unsqueeze(1)
-            object_num = torch.tensor(
-                object_num, dtype=torch.float, device=self.device
-            ).unsqueeze(1)
+            # 5つの統計量をまとめて1回でdeviceへ転送する
+            step_stats = self._upload_step_stats(
+                reward, exp_area, distance, ci, object_num, self.device
+            )
 
-            current_episode_reward += reward
-            current_episode_exp_area += exp_area
-            current_episode_distance += distance
-            current_episode_ci += ci
-            current_episode_object_num += object_num
+            current_episode_stats += step_stats
             next_episodes = self.envs.current_episodes()
             envs_to_pause = []
 
@@ -1198,7 +1198,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     envs_to_pause.append(i)
 
                 # episode ended
-                if not_done_masks[i].item() == 0:
+                if dones[i]:
                     """
                     eval_take_picture_writer.write(str(len(stats_episodes)) + "," + str(current_episodes[i].episode_id) + "," + str(n))
                     eval_picture_position_writer.write(str(len(stats_episodes)) + "," + str(current_episodes[i].episode_id) + "," + str(n))
@@ -1215,21 +1215,14 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     """
                     
                     pbar.update()
-                    episode_stats = dict()
-                    episode_stats["reward"] = current_episode_reward[i].item()
-                    episode_stats["exp_area"] = current_episode_exp_area[i].item()
-                    episode_stats["distance"] = current_episode_distance[i].item()
-                    episode_stats["ci"] = current_episode_ci[i].item()
-                    episode_stats["object_num"] = current_episode_object_num[i].item()
-                    
-                    episode_stats.update(
-                        self._extract_scalars_from_info(infos[i])
+                    episode_stats = dict(
+                        zip(_EPISODE_STAT_KEYS, current_episode_stats[i].tolist())
                     )
-                    current_episode_reward[i] = 0
-                    current_episode_exp_area[i] = 0
-                    current_episode_distance[i] = 0
-                    current_episode_ci[i] = 0
-                    current_episode_object_num[i] = 0
+                    
+                    # 動画の保存でも使うのでinfoの走査は1回だけにする
+                    scalars = self._extract_scalars_from_info_cached(infos[i])
+                    episode_stats.update(scalars)
+                    current_episode_stats[i].zero_()
                     # use scene_id + episode_id as unique id for storing stats
                     stats_episodes[
                         (
@@ -1246,16 +1239,17 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     _ci = 0.0
                     for j in range(len(self._taken_picture_list[i])):
                         _ci += self._taken_picture_list[i][j][0]
-                    eval_ci_logger.writeLine(str(_ci))
+                    eval_ci_logger.writeRow([_ci])
 
                     if len(self.config.VIDEO_OPTION) > 0:
+                        # 合成待ちのフレームを受け取る(順番はsubmitした順)
+                        rgb_frames[i] = [future.result() for future in rgb_frames[i]]
                         if len(rgb_frames[i]) == 0:
-                            frame = observations_to_image(observations[i], infos[i], actions[i].cpu().numpy())
+                            frame = observations_to_image(observations[i], infos[i], actions_cpu[i].numpy())
                             rgb_frames[i].append(frame)
                         picture = rgb_frames[i][-1]
-                        for j in range(50):
-                           rgb_frames[i].append(picture) 
-                        metrics=self._extract_scalars_from_info(infos[i])
+                        rgb_frames[i].extend([picture] * 50)
+                        metrics = scalars
                         name_ci = 0.0
                         
                         for j in range(len(self._taken_picture_list[i])):
@@ -1297,19 +1291,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
                                 
                             name_p = self._taken_picture_list[i][j][0]
                             picture_name = "episode=" + str(current_episodes[i].episode_id)+ "-ckpt=" + str(checkpoint_index) + "-" + str(j) + "-" + str(name_p)
-                            dir_name = "./taken_picture/" + date 
-                            if not os.path.exists(dir_name):
-                                os.makedirs(dir_name)
-                        
                             picture = self._taken_picture[i][j]
-                            plt.figure()
-                            ax = plt.subplot(1, 1, 1)
-                            ax.axis("off")
-                            plt.imshow(picture)
-                            plt.subplots_adjust(left=0.1, right=0.95, bottom=0.05, top=0.95)
-                            path = dir_name + "/" + picture_name + ".png"
+                            path = picture_dir_name + "/" + picture_name + ".png"
                         
-                            plt.savefig(path)
+                            # PNGの書き出しは別スレッドで行い、次のステップと並行させる
+                            picture_futures.append(
+                                picture_pool.submit(Image.fromarray(picture).save, path)
+                            )
                         
                         #Save score_matrics
                         """
@@ -1331,18 +1319,15 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
                 # episode continues
                 elif len(self.config.VIDEO_OPTION) > 0:
-                    frame = observations_to_image(observations[i], infos[i], actions[i].cpu().numpy())
-                    rgb_frames[i].append(frame)
+                    rgb_frames[i].append(
+                        frame_pool.submit(observations_to_image, observations[i], infos[i], actions_cpu[i].numpy())
+                    )
 
             (
                 self.envs,
                 test_recurrent_hidden_states,
                 not_done_masks,
-                current_episode_reward,
-                current_episode_exp_area,
-                current_episode_distance,
-                current_episode_ci,
-                current_episode_object_num,
+                current_episode_stats,
                 prev_actions,
                 batch,
                 rgb_frames,
@@ -1351,16 +1336,19 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 self.envs,
                 test_recurrent_hidden_states,
                 not_done_masks,
-                current_episode_reward,
-                current_episode_exp_area,
-                current_episode_distance,
-                current_episode_ci,
-                current_episode_object_num,
+                current_episode_stats,
                 prev_actions,
                 batch,
                 rgb_frames,
             )
 
+        # 写真の保存が全て終わるのを待つ(失敗していたらここで例外になる)
+        if frame_pool is not None:
+            frame_pool.shutdown(wait=True)
+        picture_pool.shutdown(wait=True)
+        for future in picture_futures:
+            future.result()
+
         num_episodes = len(stats_episodes)
         
         aggregated_stats = dict()
@@ -1379,12 +1367,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
         if "extra_state" in ckpt_dict and "step" in ckpt_dict["extra_state"]:
             step_id = ckpt_dict["extra_state"]["step"]
         
-        eval_reward_logger.writeLine(str(step_id) + "," + str(aggregated_stats["reward"]))
+        eval_reward_logger.writeRow([step_id, aggregated_stats["reward"]])
 
         metrics = {k: v for k, v in aggregated_stats.items() if k != "reward"}
 
         logger.info("CI:" + str(metrics["ci"]))
-        eval_metrics_logger.writeLine(str(step_id) + "," + str(metrics["ci"]) + "," + str(metrics["exp_area"]) + "," + str(metrics["distance"]) + "," + str(metrics["raw_metrics.agent_path_length"]) + "," + str(metrics["object_num"]))
+        eval_metrics_logger.writeRow([step_id, metrics["ci"], metrics["exp_area"], metrics["distance"], metrics["raw_metrics.agent_path_length"], metrics["object_num"]])
+        self.log_manager.flushAll()
 
         self.envs.close()
         
@@ -1445,32 +1434,22 @@ class PPOTrainerO(BaseRLTrainerOracle):
         self._target_index_list = []
         self._taken_index_list = []
         # 1回のCIを保存
-        self._observed_object_ci_one = []
+        self._observed_object_ci_one = np.zeros((self.envs.num_envs, 3), dtype=np.int64)
         
         for i in range(self.envs.num_envs):
             self._taken_picture.append([])
             self._taken_picture_list.append([])
             self._target_index_list.append([maps.MAP_TARGET_POINT_INDICATOR, maps.MAP_TARGET_POINT_INDICATOR+1, maps.MAP_TARGET_POINT_INDICATOR+2])
             self._taken_index_list.append([])
-            self._observed_object_ci_one.append([0, 0, 0])
         
         observations = self.envs.reset()
-        batch = batch_obs(observations, device=self.device)
+        # 観測はpinned bufferに詰めて使い回し、非同期でdeviceへ転送する
+        obs_pin_cache = {}
+        batch = batch_obs(observations, device=self.device, cache=obs_pin_cache)
 
-        current_episode_reward = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_exp_area = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_distance = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_ci = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
-        )
-        current_episode_object_num = torch.zeros(
-            self.envs.num_envs, 1, device=self.device
+        # 列は_EPISODE_STAT_KEYSの順 [reward, exp_area, distance, ci, object_num]
+        current_episode_stats = torch.zeros(
+            self.envs.num_envs, len(_EPISODE_STAT_KEYS), device=self.device
         )
         
         test_recurrent_hidden_states = torch.zeros(
@@ -1491,18 +1470,35 @@ class PPOTrainerO(BaseRLTrainerOracle):
         rgb_frames = [
             [] for _ in range(self.config.NUM_PROCESSES)
         ]  # type: List[List[np.ndarray]]
+        # 撮った写真の保存先は最初に1回だけ作る
+        picture_dir_name = "./taken_picture/" + date
         if len(self.config.VIDEO_OPTION) > 0:
             os.makedirs(self.config.VIDEO_DIR+"/"+date, exist_ok=True)
+            os.makedirs(picture_dir_name, exist_ok=True)
 
         pbar = tqdm.tqdm(total=self.config.TEST_EPISODE_COUNT)
         self.actor_critic.eval()
         
         #################################
         #Grad Camで使う層を決める(まずはRGBだけ)
-        target_layers_rgb = [self.actor_critic.net.visual_encoder.cnn[-4]]
-        cam = GradCAM(
-            model=self.actor_critic.net.visual_encoder, target_layers=target_layers_rgb
-        )
+        gradcam_enabled = self.config.GRADCAM.ENABLED
+        gradcam_stride = max(self.config.GRADCAM.STRIDE, 1)
+        if gradcam_enabled:
+            if GradCAM is None:
+                raise ImportError(
+                    "GRADCAM.ENABLED requires pytorch_grad_cam (pip install grad-cam)"
+                )
+            visual_encoder = self.actor_critic.net.visual_encoder
+            target_layers_rgb = [visual_encoder.cnn[-4]]
+            cam = GradCAM(
+                model=_VisualEncoderCAMInput(visual_encoder), target_layers=target_layers_rgb
+            )
+            # 行動の数は少ないので、行動ごとのtargetを最初に作っておく
+            cam_targets = [
+                [ClassifierOutputTarget(a)] for a in range(self.envs.action_spaces[0].n)
+            ]
+            grad_dir_name = "./taken_grad/" + date
+            os.makedirs(grad_dir_name, exist_ok=True)
         #################################
         step_num = 0
         
@@ -1512,13 +1508,14 @@ class PPOTrainerO(BaseRLTrainerOracle):
         ):
             current_episodes = self.envs.current_episodes()
 
-            with torch.no_grad():
+            # 評価では勾配もversion counterも不要なのでinference_modeで推論する
+            with torch.inference_mode():
                 (
                     _,
                     actions,
                     _,
                     test_recurrent_hidden_states,
-                ) = self.actor_critic.act(
+                ) = self.actor_critic.act_inference(
                     batch,
                     test_recurrent_hidden_states,
                     prev_actions,
@@ -1531,96 +1528,78 @@ class PPOTrainerO(BaseRLTrainerOracle):
             #################################
             #policy_gradcam(self.actor_critic.net.visual_encoder, observations[0])
             
-            # Grad Camについて
-            cnn_input = []
-            logger.info("SHAPE1: " + str(len(observations)))
-            logger.info("SHAPE3: " + str(observations[0]["rgb"].shape))
-            if self.actor_critic.net.visual_encoder._n_input_rgb > 0:
-                rgb_observations = torch.from_numpy(observations[0]["rgb"]).clone()
-                # permute tensor to dimension [BATCH x CHANNEL x HEIGHT X WIDTH]
-                rgb_observations = rgb_observations.permute(2, 0, 1)
-                rgb_observations = rgb_observations / 255.0  # normalize RGB
-                cnn_input.append(rgb_observations)
-
-            if self.actor_critic.net.visual_encoder._n_input_depth > 0:
-                depth_observations = torch.from_numpy(observations[0]["depth"]).clone()
-                # permute tensor to dimension [BATCH x CHANNEL x HEIGHT X WIDTH]
-                depth_observations = depth_observations.permute(2, 0, 1)
-                cnn_input.append(depth_observations)
-
-            cnn_input = torch.cat(cnn_input, dim=0)
-            grayscale_cam = cam(
-                input_tensor=cnn_input,
-                targets=[ClassifierOutputTarget(actions[0])],
-            )
-            # 最初の出力だけ取得
-            grayscale_cam = grayscale_cam[0, :]
-            visualization = show_cam_on_image(observations[0]["RGB"].permute(0, 3, 1, 2).numpy(), grayscale_cam, use_rgb=True)
-            fig, ax = plt.subplots(1,2)
-            ax[0].imshow(img.permute(1, 2, 0).numpy())
-            ax[1].imshow(visualization)
-            
-            dir_name = "./taken_grad/" + date
-            if not os.path.exists(dir_name):
-                os.makedirs(dir_name)
-            picture_name = "episode=" + str(current_episodes[i].episode_id)+ "-" + str(step_num) + "-" + str(actions[0])
-            path = dir_name + "/" + picture_name + ".png"
-            plt.savefig(path)
+            # 1ステップにつき1回だけdeviceからactionを転送する
+            actions_cpu = actions.cpu()
+
+            # Grad Camについて(GRADCAM.STRIDEステップに1回だけ計算する)
+            if gradcam_enabled and step_num % gradcam_stride == 0:
+                # 入力はdevice上のbatchをそのまま使う(env 0の[1, H, W, rgb+depth])
+                # 正規化と並べ替えはvisual_encoderのforwardで行う
+                cnn_input = []
+                if visual_encoder._n_input_rgb > 0:
+                    cnn_input.append(batch["rgb"][:1].float())
+                if visual_encoder._n_input_depth > 0:
+                    cnn_input.append(batch["depth"][:1].float())
+                cnn_input = torch.cat(cnn_input, dim=-1)
+                grayscale_cam = cam(
+                    input_tensor=cnn_input,
+                    targets=cam_targets[actions_cpu[0].item()],
+                )
+                # 最初の出力だけ取得
+                grayscale_cam = grayscale_cam[0, :]
+                rgb_img = observations[0]["rgb"]
+                visualization = show_cam_on_image(rgb_img.astype(np.float32) / 255.0, grayscale_cam, use_rgb=True)
+                
+                # 元画像とヒートマップを横に並べてそのまま書き出す(matplotlibの図は作らない)
+                picture_name = "episode=" + str(current_episodes[0].episode_id)+ "-" + str(step_num) + "-" + str(actions_cpu[0].item())
+                path = grad_dir_name + "/" + picture_name + ".png"
+                cv2.imwrite(
+                    path,
+                    cv2.cvtColor(np.concatenate([rgb_img, visualization], axis=1), cv2.COLOR_RGB2BGR),
+                )
             #################################
 
-            outputs = self.envs.step([a[0].item() for a in actions])
+            outputs = self.envs.step(actions_cpu[:, 0].tolist())
  
-            observations, rewards, dones, infos = [
-                list(x) for x in zip(*outputs)
-            ]
-            batch = batch_obs(observations, device=self.device)
+            # 各envの出力はタプルのまま使い、doneだけbool配列にする
+            observations, rewards, dones, infos = zip(*outputs)
+            dones = np.asarray(dones, dtype=bool)
+            batch = batch_obs(observations, device=self.device, cache=obs_pin_cache)
             
-            not_done_masks = torch.tensor(
-                [[0.0] if done else [1.0] for done in dones],
-                dtype=torch.float,
-                device=self.device,
-            )
+            not_done_masks = torch.from_numpy(~dones).to(
+                device=self.device, dtype=torch.float
+            ).unsqueeze(1)
             
-            for n in range(self.envs.num_envs):
-                self._observed_object_ci_one[n] = [0, 0, 0] 
+            self._observed_object_ci_one.fill(0)
             
-            reward = []
-            ci = []
-            exp_area = [] # 探索済みのエリア()
-            exp_area_pre = []
-            distance = []
-            fog_of_war_map = []
-            top_down_map = [] 
-            top_map = []
-            object_num = []
             n_envs = self.envs.num_envs
+            # rewards[i][0] = [reward, ci, area, area_pre, distance, distance_pre]
+            # ciはTAKE_PICTUREが呼ばれていない時 -sys.float_info.max なのでfloat64で保持する
+            reward_stats = np.array([r[0][:4] for r in rewards], dtype=np.float64)
+            reward = reward_stats[:, 0].copy()
+            ci = reward_stats[:, 1].copy()
+            exp_area = reward_stats[:, 2] - reward_stats[:, 3] # 探索済みのエリア()
+            exp_area_pre = reward_stats[:, 3]
+            object_num = np.zeros(n_envs, dtype=np.float64)
+            fog_of_war_map = [info["picture_range_map"]["fog_of_war_mask"] for info in infos]
+            top_down_map = [info["picture_range_map"]["map"] for info in infos]
+            top_map = [info["top_down_map"]["map"] for info in infos]
             
+            # multi goal distanceの計算(まだ残っているtargetの分だけ足す)
+            distance_cur = np.array([r[0][4] for r in rewards], dtype=np.float64)
+            distance_pre = np.array([r[0][5] for r in rewards], dtype=np.float64)
+            target_mask = np.zeros(distance_cur.shape, dtype=bool)
             for i in range(n_envs):
-                reward.append(rewards[i][0][0])
-                ci.append(rewards[i][0][1])
-                exp_area.append(rewards[i][0][2]-rewards[i][0][3])
-                exp_area_pre.append(rewards[i][0][3])
-                fog_of_war_map.append(infos[i]["picture_range_map"]["fog_of_war_mask"])
-                top_down_map.append(infos[i]["picture_range_map"]["map"])
-                top_map.append(infos[i]["top_down_map"]["map"])
-                object_num.append(0)
-                
-                # multi goal distanceの計算
-                dis = 0.0
-                dis_pre = 0
-                for j in self._target_index_list[i]:
-                    dis_pre += rewards[i][0][5][j-maps.MAP_TARGET_POINT_INDICATOR]
-                    dis += rewards[i][0][4][j-maps.MAP_TARGET_POINT_INDICATOR]
-            
-                reward[i] += dis_pre - dis
-                distance.append(dis_pre - dis)
+                target_mask[i, np.asarray(self._target_index_list[i], dtype=np.int64) - maps.MAP_TARGET_POINT_INDICATOR] = True
+            distance = np.where(target_mask, distance_pre - distance_cur, 0.0).sum(axis=1)
+            reward += distance
             
             for n in range(len(observations)):
             #TAKE_PICTUREが呼び出されたかを検証
                 if ci[n] != -sys.float_info.max:
-                    # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)とかぶっているkを保存
-                    cover_list = [] 
                     picture_range_map = self._create_picture_range_map(top_down_map[n], fog_of_war_map[n])
+                    # 写真を撮った範囲(==1)はステップごとに1回だけ求め、ビット列に詰めて被りの計算に使う
+                    picture_mask = np.packbits(picture_range_map == 1)
                     ci[n], object_num[n] = self._do_take_picture_object(top_map, fog_of_war_map, n)
                     
                     if ci[n] == 0:
@@ -1628,25 +1607,19 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     
                     # p_kのそれぞれのpicture_range_mapのリスト
                     pre_fog_of_war_map = [sublist[1] for sublist in self._taken_picture_list[n]]
+                    stored_ci = np.array([sublist[0] for sublist in self._taken_picture_list[n]], dtype=np.float64)
                         
-                    # それぞれと閾値より被っているか計算
-                    idx = -1
-                    min_ci = ci[n]
-                    for k in range(len(pre_fog_of_war_map)):
-                        # 閾値よりも被っていたらcover_listにkを追加
-                        if self._check_percentage_of_fog(picture_range_map, pre_fog_of_war_map[k]) == True:
-                            cover_list.append(k)
-                                
-                        #ciの最小値の写真を探索(１つも被っていない時用)
-                        if min_ci < self._taken_picture_list[n][idx][0]:
-                            idx = k
-                            min_ci = self._taken_picture_list[n][idx][0]
+                    # 今回撮ったpicture(p_n)が保存してあるpicture(p_k)と閾値より被っているkを保存
+                    cover_list = self._find_covered_pictures(picture_range_map, picture_mask, self._taken_picture_list[n])
+                    
+                    #ciの最小値の写真を探索(１つも被っていない時用)
+                    idx = _min_ci_index(stored_ci, ci[n])
                             
                     # 今までの写真と多くは被っていない時
                     if len(cover_list) == 0:
                         #範囲が多く被っていなくて、self._num_picture回未満写真を撮っていたらそのまま保存
                         if len(self._taken_picture_list[n]) != self._num_picture:
-                            self._taken_picture_list[n].append([ci[n], picture_range_map])
+                            self._taken_picture_list[n].append([ci[n], picture_range_map, picture_mask])
                             if len(self.config.VIDEO_OPTION) > 0:
                                 self._taken_picture[n].append(observations[n]["rgb"])
                             reward[n] += ci[n]
@@ -1656,7 +1629,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                             # 今回の写真が保存してある写真の１つでもCIが高かったらCIが最小の保存写真と入れ替え
                             if idx != -1:
                                 ci_pre = self._taken_picture_list[n][idx][0]
-                                self._taken_picture_list[n][idx] = [ci[n], picture_range_map]
+                                self._taken_picture_list[n][idx] = [ci[n], picture_range_map, picture_mask]
                                 if len(self.config.VIDEO_OPTION) > 0:
                                     self._taken_picture[n][idx] = observations[n]["rgb"]   
                                 reward[n] += (ci[n] - ci_pre) 
@@ -1666,18 +1639,13 @@ class PPOTrainerO(BaseRLTrainerOracle):
                             
                     # 1つとでも多く被っていた時    
                     else:
-                        min_idx = -1
-                        min_ci_k = 1000
                         # 多く被った写真のうち、ciが最小のものを計算
-                        for k in range(len(cover_list)):
-                            idx_k = cover_list[k]
-                            if self._taken_picture_list[n][idx_k][0] < min_ci_k:
-                                min_ci_k = self._taken_picture_list[n][idx_k][0]
-                                min_idx = idx_k
+                        min_idx = cover_list[int(stored_ci[cover_list].argmin())]
+                        min_ci_k = stored_ci[min_idx]
                                     
                         # 被った割合分小さくなったCIでも保存写真の中の最小のCIより大きかったら交換
                         if self._compareWithChangedCI(picture_range_map, pre_fog_of_war_map, cover_list, ci[n], min_ci_k, min_idx) == True:
-                            self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map]
+                            self._taken_picture_list[n][min_idx] = [ci[n], picture_range_map, picture_mask]
                             if len(self.config.VIDEO_OPTION) > 0:
                                 self._taken_picture[n][min_idx] = observations[n]["rgb"]   
                             reward[n] += (ci[n] - min_ci_k)  
@@ -1687,17 +1655,12 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 else:
                     ci[n] = 0.0
                 
-            reward = torch.tensor(reward, dtype=torch.float, device=self.device).unsqueeze(1)
-            exp_area = torch.tensor(exp_area, dtype=torch.float, device=self.device).unsqueeze(1)
-            distance = torch.tensor(distance, dtype=torch.float, device=self.device).unsqueeze(1)
-            ci= torch.tensor(ci, dtype=torch.float, device=self.device).unsqueeze(1)
-            object_num = torch.tensor(object_num, dtype=torch.float, device=self.device).unsqueeze(1)
-
-            current_episode_reward += reward
-            current_episode_exp_area += exp_area
-            current_episode_distance += distance
-            current_episode_ci += ci
-            current_episode_object_num += object_num
+            # 5つの統計量をまとめて1回でdeviceへ転送する
+            step_stats = self._upload_step_stats(
+                reward, exp_area, distance, ci, object_num, self.device
+            )
+
+            current_episode_stats += step_stats
             next_episodes = self.envs.current_episodes()
             envs_to_pause = []
 
@@ -1709,23 +1672,16 @@ class PPOTrainerO(BaseRLTrainerOracle):
                     envs_to_pause.append(i)
 
                 # episode ended
-                if not_done_masks[i].item() == 0:
+                if dones[i]:
                     pbar.update()
-                    episode_stats = dict()
-                    episode_stats["reward"] = current_episode_reward[i].item()
-                    episode_stats["exp_area"] = current_episode_exp_area[i].item()
-                    episode_stats["distance"] = current_episode_distance[i].item()
-                    episode_stats["ci"] = current_episode_ci[i].item()
-                    episode_stats["object_num"] = current_episode_object_num[i].item()
-                    
-                    episode_stats.update(
-                        self._extract_scalars_from_info(infos[i])
+                    episode_stats = dict(
+                        zip(_EPISODE_STAT_KEYS, current_episode_stats[i].tolist())
                     )
-                    current_episode_reward[i] = 0
-                    current_episode_exp_area[i] = 0
-                    current_episode_distance[i] = 0
-                    current_episode_ci[i] = 0
-                    current_episode_object_num[i] = 0
+                    
+                    # 動画の保存でも使うのでinfoの走査は1回だけにする
+                    scalars = self._extract_scalars_from_info_cached(infos[i])
+                    episode_stats.update(scalars)
+                    current_episode_stats[i].zero_()
                     # use scene_id + episode_id as unique id for storing stats
                     stats_episodes[
                         (
@@ -1741,12 +1697,11 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
                     if len(self.config.VIDEO_OPTION) > 0:
                         if len(rgb_frames[i]) == 0:
-                            frame = observations_to_image(observations[i], infos[i], actions[i].cpu().numpy())
+                            frame = observations_to_image(observations[i], infos[i], actions_cpu[i].numpy())
                             rgb_frames[i].append(frame)
                         picture = rgb_frames[i][-1]
-                        for j in range(50):
-                           rgb_frames[i].append(picture) 
-                        metrics=self._extract_scalars_from_info(infos[i])
+                        rgb_frames[i].extend([picture] * 50)
+                        metrics = scalars
                         name_ci = 0.0
                         
                         for j in range(len(self._taken_picture_list[i])):
@@ -1776,19 +1731,11 @@ class PPOTrainerO(BaseRLTrainerOracle):
                         for j in range(len(self._taken_picture_list[i])):                
                             name_p = self._taken_picture_list[i][j][0]
                             picture_name = "episode=" + str(current_episodes[i].episode_id)+ "-ckpt=" + str(checkpoint_index) + "-" + str(j) + "-" + str(name_p)
-                            dir_name = "./taken_picture/" + date 
-                            if not os.path.exists(dir_name):
-                                os.makedirs(dir_name)
-                        
                             picture = self._taken_picture[i][j]
-                            plt.figure()
-                            ax = plt.subplot(1, 1, 1)
-                            ax.axis("off")
-                            plt.imshow(picture)
-                            plt.subplots_adjust(left=0.1, right=0.95, bottom=0.05, top=0.95)
-                            path = dir_name + "/" + picture_name + ".png"
+                            path = picture_dir_name + "/" + picture_name + ".png"
                         
-                            plt.savefig(path)
+                            # matplotlibの図は作らずにRGB画像をそのまま書き出す
+                            cv2.imwrite(path, cv2.cvtColor(picture, cv2.COLOR_RGB2BGR))
                             
                         rgb_frames[i] = []
                         
@@ -1799,7 +1746,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
 
                 # episode continues
                 elif len(self.config.VIDEO_OPTION) > 0:
-                    frame = observations_to_image(observations[i], infos[i], actions[i].cpu().numpy())
+                    frame = observations_to_image(observations[i], infos[i], actions_cpu[i].numpy())
                     rgb_frames[i].append(frame)
                     step_num += 1
 
@@ -1807,11 +1754,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 self.envs,
                 test_recurrent_hidden_states,
                 not_done_masks,
-                current_episode_reward,
-                current_episode_exp_area,
-                current_episode_distance,
-                current_episode_ci,
-                current_episode_object_num,
+                current_episode_stats,
                 prev_actions,
                 batch,
                 rgb_frames,
@@ -1820,11 +1763,7 @@ class PPOTrainerO(BaseRLTrainerOracle):
                 self.envs,
                 test_recurrent_hidden_states,
                 not_done_masks,
-                current_episode_reward,
-                current_episode_exp_area,
-                current_episode_distance,
-                current_episode_ci,
-                current_episode_object_num,
+                current_episode_stats,
                 prev_actions,
                 batch,
                 rgb_frames,
@@ -1848,12 +1787,18 @@ class PPOTrainerO(BaseRLTrainerOracle):
         if "extra_state" in ckpt_dict and "step" in ckpt_dict["extra_state"]:
             step_id = ckpt_dict["extra_state"]["step"]
         
-        grad_reward_logger.writeLine(str(step_id) + "," + str(aggregated_stats["reward"]))
+        grad_reward_logger.writeRow([step_id, aggregated_stats["reward"]])
 
         metrics = {k: v for k, v in aggregated_stats.items() if k != "reward"}
 
         logger.info("CI:" + str(metrics["ci"]))
-        grad_metrics_logger.writeLine(str(step_id) + "," + str(metrics["ci"]) + "," + str(metrics["exp_area"]) + "," + str(metrics["distance"]) + "," + str(metrics["raw_metrics.agent_path_length"]) + "," + str(metrics["object_num"]))
+        grad_metrics_logger.writeRow([step_id, metrics["ci"], metrics["exp_area"], metrics["distance"], metrics["raw_metrics.agent_path_length"], metrics["object_num"]])
+        self.log_manager.flushAll()
+
+        # visual_encoderに付けたhookを外しておく(次のcheckpointのforwardを遅くしないように)
+        if gradcam_enabled:
+            cam.activations_and_grads.release()
+            del cam
 
         self.envs.close()
     
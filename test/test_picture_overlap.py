@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Meta Platforms, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("habitat_baselines")
+
+from habitat_baselines.rl.ppo.ppo_trainer import (
+    PPOTrainerO,
+    _min_ci_index,
+    _popcount,
+)
+
+
+def _check_percentage_of_fog_loop(fog_map, pre_fog_map, threshold=0.25):
+    # Reference: the original per-cell overlap test
+    if len(fog_map) != len(pre_fog_map) or len(fog_map[0]) != len(
+        pre_fog_map[0]
+    ):
+        return False
+
+    num = 0
+    num_covered = 0
+    for i in range(len(fog_map)):
+        for j in range(len(fog_map[0])):
+            if fog_map[i][j] == 1:
+                num += 1
+                if pre_fog_map[i][j] == 1:
+                    num_covered += 1
+
+    if num == 0:
+        return False
+    return num_covered / num >= threshold
+
+
+def _taken_picture(picture_range_map):
+    return [0.0, picture_range_map, np.packbits(picture_range_map == 1)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_find_covered_pictures_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    shape = (23, 17)
+    fog_map = rng.integers(0, 3, size=shape, dtype=np.uint8)
+    taken_picture_list = [
+        _taken_picture(rng.integers(0, 3, size=shape, dtype=np.uint8))
+        for _ in range(8)
+    ]
+    # Maps of another size are never counted as covered
+    taken_picture_list.insert(
+        3, _taken_picture(np.ones((17, 23), dtype=np.uint8))
+    )
+
+    expected = [
+        k
+        for k, taken_picture in enumerate(taken_picture_list)
+        if _check_percentage_of_fog_loop(fog_map, taken_picture[1])
+    ]
+    covered = PPOTrainerO._find_covered_pictures(
+        None, fog_map, np.packbits(fog_map == 1), taken_picture_list
+    )
+    assert covered == expected
+    assert 3 not in covered
+
+
+def test_find_covered_pictures_empty_picture():
+    # num == 0: nothing is taken in the current picture
+    fog_map = np.full((10, 10), 2, dtype=np.uint8)
+    taken_picture_list = [_taken_picture(np.ones((10, 10), dtype=np.uint8))]
+    assert (
+        PPOTrainerO._find_covered_pictures(
+            None, fog_map, np.packbits(fog_map == 1), taken_picture_list
+        )
+        == []
+    )
+    assert not _check_percentage_of_fog_loop(
+        fog_map, taken_picture_list[0][1]
+    )
+
+
+def test_popcount():
+    rng = np.random.default_rng(0)
+    bits = rng.integers(0, 2, size=(4, 101), dtype=np.uint8).astype(bool)
+    packed = np.packbits(bits, axis=1)
+    assert _popcount(packed) == np.count_nonzero(bits)
+    assert (_popcount(packed, axis=1) == bits.sum(axis=1)).all()
+
+
+def test_min_ci_index():
+    stored_ci = np.array([3.0, 1.0, 2.0, 1.0])
+    # The first smallest stored picture is replaced
+    assert _min_ci_index(stored_ci, 1.5) == 1
+    # Only when it is smaller than the new ci
+    assert _min_ci_index(stored_ci, 1.0) == -1
+    assert _min_ci_index(np.array([], dtype=np.float64), 1.0) == -1
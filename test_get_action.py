@@ -1,5 +1,7 @@
 import csv
-import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
 
 def read_adjacency_matrix(file_path):
     adjacency_matrix = {}
@@ -14,19 +16,44 @@ def read_adjacency_matrix(file_path):
             print(f"{node_name}: {adjacency_matrix[node_name]}")
     return adjacency_matrix,nodes
 
-def find_shortest_path(adjacency_matrix, start_node, end_node):
-    G = nx.Graph()
+def build_graph(adjacency_matrix):
+    # ノード名に番号を振り、無向グラフの隣接行列(CSR)を一度だけ作る
+    node_to_idx = {}
+    for node, neighbors in adjacency_matrix.items():
+        node_to_idx.setdefault(node, len(node_to_idx))
+        for neighbor in neighbors:
+            node_to_idx.setdefault(neighbor, len(node_to_idx))
 
+    rows = []
+    cols = []
     for node, neighbors in adjacency_matrix.items():
-        for neighbor, angle in neighbors.items():
-            G.add_edge(node, neighbor, weight=1)
-                
-    try:
-        shortest_path = nx.shortest_path(G, source=start_node, target=end_node)
-        shortest_path_cost = nx.shortest_path_length(G, source=start_node, target=end_node)
-        return shortest_path_cost, shortest_path
-    except nx.NetworkXNoPath:
+        for neighbor in neighbors:
+            rows.append(node_to_idx[node])
+            cols.append(node_to_idx[neighbor])
+
+    num_nodes = len(node_to_idx)
+    graph = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_nodes, num_nodes))
+    return graph, node_to_idx, list(node_to_idx)
+
+def find_shortest_path(adjacency_matrix, start_node, end_node, graph=None):
+    # 辺の重みは全て1なので幅優先探索で最短経路を求める
+    if graph is None:
+        graph = build_graph(adjacency_matrix)
+    csr, node_to_idx, idx_to_node = graph
+
+    start = node_to_idx[start_node]
+    end = node_to_idx[end_node]
+    _, predecessors = breadth_first_order(
+        csr, start, directed=False, return_predecessors=True
+    )
+    if start != end and predecessors[end] < 0:
         return float('inf'), []
+
+    path = [end]
+    while path[-1] != start:
+        path.append(predecessors[path[-1]])
+    shortest_path = [idx_to_node[i] for i in reversed(path)]
+    return len(shortest_path) - 1, shortest_path
     
 def read_node_positions(file_path):
     node_positions = {}
@@ -81,7 +108,8 @@ if __name__ == "__main__":
 
     if start_node not in nodes or end_node not in nodes:
         print("Invalid node names.")
-    shortest_path_cost, shortest_path_nodes = find_shortest_path(adjacency_matrix, start_node, end_node)
+    graph = build_graph(adjacency_matrix)
+    shortest_path_cost, shortest_path_nodes = find_shortest_path(adjacency_matrix, start_node, end_node, graph)
     if shortest_path_cost == float('inf'):
         print("No path found.")
     
@@ -1,4 +1,5 @@
 import os
+import sys
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 import random
 
@@ -8,6 +9,11 @@ import gzip
 import torch
 import datetime
 import multiprocessing
+import multiprocessing.util
+import hashlib
+import functools
+import pickle
+import gc
 
 from matplotlib import pyplot as plt
 
@@ -15,24 +21,79 @@ from PIL import Image
 
 from habitat_baselines.config.default import get_config  
 from habitat.sims.habitat_simulator.habitat_simulator import HabitatSim
-from habitat.datasets.maximum_info.maximuminfo_dataset import MaximumInfoDatasetV1
-from habitat.datasets.maximum_info.maximuminfo_generator import generate_maximuminfo_episode
+from habitat.datasets.maximum_info.maximuminfo_generator import generate_maximuminfo_start_z
 from habitat_baselines.common.environments import InfoRLEnv
 from habitat_baselines.common.baseline_registry import baseline_registry
 from utils.log_manager import LogManager
 from utils.log_writer import LogWriter
 from habitat.core.logging import logger        
+
+# workerプロセスごとに1つだけ作るシミュレータ
+_SIM = None
+
+def _init_sampler(sim_config):
+    global _SIM
+    if _SIM is None:
+        _SIM = HabitatSim(config=sim_config)
+        # 使い回したシミュレータはプロセス終了時(Poolのworkerではpoolのclose/join時)に閉じる
+        multiprocessing.util.Finalize(None, _close_sampler, exitpriority=10)
+    else:
+        # 既にシミュレータがあればシーンだけ入れ替えて使い回す
+        _SIM.reconfigure(sim_config)
+    # 全workerが同じ点をサンプリングしないように、workerごとに別のseedを使う
+    identity = multiprocessing.current_process()._identity
+    worker_id = identity[0] if identity else 0
+    _SIM.seed(sim_config.SEED + worker_id)
+
+def _close_sampler():
+    global _SIM
+    if _SIM is None:
+        return
+    _SIM.close()
+    _SIM = None
+    gc.collect()
+
+def _sample_start_z(num_episodes):
+    # 使うのはz軸だけなので、エピソードは作らずz軸の値の配列だけを作ってプロセス間で送る
+    return generate_maximuminfo_start_z(sim=_SIM, num_episodes=num_episodes)
        
-def research_valid_z():
+def _build_z_histogram(config, num, num_workers, chunk_size, reuse_sim):
+    # num個のエピソードをchunk_sizeずつに分け、シミュレータを持ったworkerプロセスで並列にサンプリングする
+    chunks = [chunk_size] * (num // chunk_size)
+    if num % chunk_size > 0:
+        chunks.append(num % chunk_size)
+    if num_workers <= 1:
+        # シーンごとのworker(daemon)からは子プロセスを作れないので、このプロセス内でサンプリングする
+        _init_sampler(config.TASK_CONFIG.SIMULATOR)
+        positions = np.concatenate([_sample_start_z(n) for n in chunks])
+        # 次のシーンで使い回さないなら、ヒストグラムを作る前にシミュレータを解放し、ピーク時のメモリを減らす
+        if not reuse_sim:
+            _close_sampler()
+    else:
+        with multiprocessing.get_context("spawn").Pool(
+            processes=num_workers,
+            initializer=_init_sampler,
+            initargs=(config.TASK_CONFIG.SIMULATOR,),
+        ) as pool:
+            # 各エピソードのz軸の値を1つの配列にまとめる
+            positions = np.concatenate(list(pool.imap_unordered(_sample_start_z, chunks)))
+        # withを抜けるとworkerごと各シミュレータも終了している
+        
+    logger.info("Create datasets")
+    # 値ごとの個数を数える
+    # z軸の値は整数(1e-6単位)にしてから数え、各値の代表には元のz軸の値を使う
+    position_keys = np.round(positions * 1e6).astype(np.int64)
+    _, first_index, position_counts = np.unique(
+        position_keys, return_index=True, return_counts=True
+    )
+    position_values = positions[first_index]
+    return position_values, position_counts
+
+def research_valid_z(scene_name, num_workers=4, chunk_size=10000, reuse_sim=False):
     exp_config = "./habitat_baselines/config/maximuminfo/ppo_maximuminfo.yaml"
     opts = None
     config = get_config(exp_config, opts)
     
-    dir_path = "data/scene_datasets/mp3d"
-    dirs = [f for f in os.listdir(dir_path) if os.path.isdir(os.path.join(dir_path, f))]
-    
-    #scene_name = dirs[scene_idx]
-    scene_name = "1LXtFkjw3qL"
     logger.info("START FOR: " + scene_name)
         
     dataset_path = "map_dataset/" + scene_name + ".json.gz"    
@@ -40,13 +101,9 @@ def research_valid_z():
     config.defrost()
     config.TASK_CONFIG.SIMULATOR.SCENE = "data/scene_datasets/mp3d/" + scene_name + "/" + scene_name + ".glb"
     config.TASK_CONFIG.DATASET.DATA_PATH = dataset_path
-    config.TASK_CONFIG.SIMULATOR.DEPTH_SENSOR.NORMALIZE_DEPTH = False
-    config.TASK_CONFIG.SIMULATOR.DEPTH_SENSOR.MIN_DEPTH = 0.0
-    config.TASK_CONFIG.SIMULATOR.DEPTH_SENSOR.MAX_DEPTH = 5.0
     config.TASK_CONFIG.SIMULATOR.AGENT_0.HEIGHT = 1.5
-    config.TASK_CONFIG.SIMULATOR.AGENT_0.SENSORS = ["RGB_SENSOR", "DEPTH_SENSOR"]
-    config.TASK_CONFIG.SIMULATOR.SEMANTIC_SENSOR.HEIGHT = 256
-    config.TASK_CONFIG.SIMULATOR.SEMANTIC_SENSOR.WIDTH = 256
+    # 使うのはナビゲーション可能な点のサンプリングだけなので、観測用のセンサは作らない
+    config.TASK_CONFIG.SIMULATOR.AGENT_0.SENSORS = []
     #config.TASK_CONFIG.SIMULATOR.HABITAT_SIM_V0.PHYSICS_CONFIG_FILE = ("data/default.phys_scene_config.json")
     config.TASK_CONFIG.TRAINER_NAME = "oracle-ego"
     config.TASK_CONFIG.DATASET.DATA_PATH = dataset_path
@@ -55,35 +112,59 @@ def research_valid_z():
         
     #データセットに入れるz軸の候補を決める
     num = 1000000
-    dataset = MaximumInfoDatasetV1()
-    sim = HabitatSim(config=config.TASK_CONFIG.SIMULATOR)
-    dataset.episodes += generate_maximuminfo_episode(sim=sim, num_episodes=num)         
-        
-    logger.info("Create datasets")
-    position_dict = {}
-    for i in range(len(dataset.episodes)):
-        position = dataset.episodes[i].start_position[1]
-        
-        num_pos = position_dict.get(position, 0)
-        position_dict[position] = num_pos+1
+    # 同じシーン・エピソード数・エージェントの高さで作ったヒストグラムはキャッシュから読み込む
+    cache_key = hashlib.sha1(
+        f"{scene_name}:{num}:{config.TASK_CONFIG.SIMULATOR.AGENT_0.HEIGHT}".encode()
+    ).hexdigest()[:12]
+    cache_path = f"cache/zhist_{scene_name}_{cache_key}.pkl.gz"
+    if os.path.exists(cache_path):
+        logger.info("LOAD CACHE: " + cache_path)
+        with gzip.open(cache_path, "rb") as f:
+            position_values, position_counts = pickle.load(f)
+    else:
+        position_values, position_counts = _build_z_histogram(
+            config, num, num_workers, chunk_size, reuse_sim
+        )
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with gzip.open(cache_path, "wb", compresslevel=1) as f:
+            pickle.dump((position_values, position_counts), f, protocol=pickle.HIGHEST_PROTOCOL)
                 
-    logger.info("LIST_SIZE: " + str(len(position_dict)))
+    logger.info("LIST_SIZE: " + str(len(position_values)))
         
     #z軸が少数だったものは削除
-    sorted_positions = sorted(position_dict.items(), key=lambda x: x[1], reverse=True)
-
-    # valueが1000以上の位置情報のみを抽出してリストに格納
-    num_list = [(key, value) for key, value in sorted_positions if value >= 1000]
+    # valueが1000以上の位置情報のみを個数の多い順に抽出してリストに格納
+    keep = position_counts >= 1000
+    position_values = position_values[keep]
+    position_counts = position_counts[keep]
+    order = np.argsort(-position_counts, kind="stable")
+    num_list = list(zip(position_values[order].tolist(), position_counts[order].tolist()))
 
     # num_listに入れたkeyとそのvalueをprint
     logger.info(scene_name)
-    for key, value in num_list:
-        print(f"Position: {key}, Value: {value}")
+    # 1回のwriteでまとめて出力し、並列に動く他シーンの出力と行が混ざらないようにする
+    sys.stdout.write("".join(f"Position: {key}, Value: {value}\n" for key, value in num_list))
+    sys.stdout.flush()
         
     z_list = num_list
+    return z_list
              
                 
 if __name__ == '__main__':
-    research_valid_z()
+    dir_path = "data/scene_datasets/mp3d"
+    # scandirはディレクトリ走査時の種類情報を使うので、エントリごとにstatを呼ばない
+    with os.scandir(dir_path) as it:
+        dirs = [entry.name for entry in it if entry.is_dir()]
+    
+    # シーンごとにworkerプロセスを分けて並列に調べる
+    # 各workerは1つのHabitatSimをreconfigureでシーンを入れ替えながら使い回す
+    with multiprocessing.get_context("spawn").Pool(
+        processes=max(1, min(len(dirs), os.cpu_count() // 2)),
+    ) as pool:
+        research = functools.partial(research_valid_z, num_workers=1, reuse_sim=True)
+        for i, _ in enumerate(pool.imap_unordered(research, dirs), 1):
+            logger.info("PROGRESS: " + str(i) + "/" + str(len(dirs)))
+        # terminateではなくworkerを正常終了させ、最後のシーンで使ったシミュレータを閉じさせる
+        pool.close()
+        pool.join()
     
     logger.info("################# FINISH EXPERIMENT !!!!! ##########################")
\ No newline at end of file
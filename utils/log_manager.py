@@ -29,6 +29,17 @@ class LogManager:
         self.writers[key] = writer
         return writer
     
+    #全てのLogWriterのバッファをファイルへ書き出す
+    def flushAll(self) -> None:
+        for writer in self.writers.values():
+            writer.flush()
+    
+    #全てのLogWriterを閉じる(閉じる時にバッファの内容も書き出される)
+    def closeAll(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+    
     #テスト用
     def printWriters(self) -> None:
         print(self.writers)
\ No newline at end of file
@@ -1,19 +1,31 @@
+import csv
+
+
 class LogWriter:
-    def __init__(self, file_path: str) -> None:
+    def __init__(self, file_path: str, buffering: int = 1 << 16) -> None:
         self.file_path = file_path
         
-        #ファイルを新規作成 or 上書き
-        with open(self.file_path, "w") as f:
-            pass
+        #ファイルを新規作成 or 上書きし、毎回開き直さずに開いたまま追記する
+        self._file = open(self.file_path, "w", newline="", buffering=buffering)
+        self._csv_writer = csv.writer(self._file, lineterminator="\n")
             
     #改行なし
     def write(self, log: str) -> None:
         #ファイルへ追記
-        with open(self.file_path, 'a', newline='') as f:
-            f.write(log + ",")
+        self._file.write(log + ",")
             
     #改行あり
     def writeLine(self, log: str="") -> None:
         #ファイルへ追記
-        with open(self.file_path, "a") as f:
-            f.write(log + "\n")
\ No newline at end of file
+        self._file.write(log + "\n")
+        
+    #値のリストをcsvの1行として書き込む
+    def writeRow(self, row) -> None:
+        self._csv_writer.writerow(row)
+        
+    #バッファの内容をファイルへ書き出す
+    def flush(self) -> None:
+        self._file.flush()
+        
+    def close(self) -> None:
+        self._file.close()